@@ -15,11 +15,27 @@ import sys
 import hashlib
 import datetime
 import time
-from collections import namedtuple
+import mmap
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from binascii import unhexlify
 
 settings = {}
 
+# A DeFi block header is the Bitcoin header without nNonce, followed by
+# stakeModifier, deprecatedHeight, mintedBlocks and a variable-length sig:
+# nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, stakeModifier,
+# deprecatedHeight, mintedBlocks
+BLOCK_HEADER_FIXED_SIZE = 124
+# Offset of nTime in the header
+BLOCK_HEADER_TIME_OFFSET = 68
+# Block record prefix in blk*.dat: network magic and block size
+BLOCK_RECORD_PREFIX_SIZE = 8
+
+# Number of input files kept memory-mapped while writing the output
+MAX_OPEN_INPUT_FILES = 16
+
 
 def hex_switchEndian(s):
     """Switches the endianness of a hex string (in pairs of hex chars)"""
@@ -27,59 +43,31 @@ def hex_switchEndian(s):
     return b"".join(pairList[::-1]).decode()
 
 
-def uint32(x):
-    return x & 0xFFFFFFFF
-
+def read_compact_size(buf, offset):
+    """Return (value, size) of the compact size integer at buf[offset]."""
+    nit = buf[offset]
+    if nit < 253:
+        return nit, 1
+    fmt = {253: "<H", 254: "<I", 255: "<Q"}[nit]
+    return struct.unpack_from(fmt, buf, offset + 1)[0], 1 + struct.calcsize(fmt)
 
-def bytereverse(x):
-    return uint32(
-        (
-            ((x) << 24)
-            | (((x) << 8) & 0x00FF0000)
-            | (((x) >> 8) & 0x0000FF00)
-            | ((x) >> 24)
-        )
-    )
 
-
-def bufreverse(in_buf):
-    out_words = []
-    for i in range(0, len(in_buf), 4):
-        word = struct.unpack("@I", in_buf[i : i + 4])[0]
-        out_words.append(struct.pack("@I", bytereverse(word)))
-    return b"".join(out_words)
-
-
-def wordreverse(in_buf):
-    out_words = []
-    for i in range(0, len(in_buf), 4):
-        out_words.append(in_buf[i : i + 4])
-    out_words.reverse()
-    return b"".join(out_words)
+def get_blk_hdr_size(buf, offset):
+    """Return the size of the block header starting at buf[offset]."""
+    siglen, n = read_compact_size(buf, offset + BLOCK_HEADER_FIXED_SIZE)
+    return BLOCK_HEADER_FIXED_SIZE + n + siglen
 
 
 def calc_hdr_hash(blk_hdr):
-    hash1 = hashlib.sha256()
-    hash1.update(blk_hdr)
-    hash1_o = hash1.digest()
-
-    hash2 = hashlib.sha256()
-    hash2.update(hash1_o)
-    hash2_o = hash2.digest()
-
-    return hash2_o
+    return hashlib.sha256(hashlib.sha256(blk_hdr).digest()).digest()
 
 
 def calc_hash_str(blk_hdr):
-    hash = calc_hdr_hash(blk_hdr)
-    hash = bufreverse(hash)
-    hash = wordreverse(hash)
-    hash_str = hash.hex()
-    return hash_str
+    return calc_hdr_hash(blk_hdr)[::-1].hex()
 
 
 def get_blk_dt(blk_hdr):
-    members = struct.unpack("<I", blk_hdr[68 : 68 + 4])
+    members = struct.unpack_from("<I", blk_hdr, BLOCK_HEADER_TIME_OFFSET)
     nTime = members[0]
     dt = datetime.datetime.fromtimestamp(nTime)
     dt_ym = datetime.datetime(dt.year, dt.month, 1)
@@ -109,23 +97,114 @@ def mkblockmap(blkindex):
     return blkmap
 
 
-# Block header and extent on disk
-BlockExtent = namedtuple("BlockExtent", ["fn", "offset", "inhdr", "blkhdr", "size"])
+def inFileName(settings, fn):
+    return os.path.join(settings["input"], "blk%05d.dat" % fn)
+
+
+def scan_block_file(fname, netmagic):
+    """Index the blocks stored in one blk*.dat file.
+
+    Returns the concatenated block hashes along with arrays of the offset and
+    size of each block record (magic and size prefix included)."""
+    hashes = []
+    offsets = array("Q")
+    sizes = array("Q")
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b"", offsets, sizes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            end = len(mm)
+            while pos + BLOCK_RECORD_PREFIX_SIZE <= end:
+                inMagic = mm[pos : pos + 4]
+                if inMagic == b"\0\0\0\0":
+                    # Zero-filled space preallocated by defid
+                    break
+                if inMagic != netmagic:
+                    raise ValueError(
+                        "Invalid magic %s in %s at offset %d"
+                        % (inMagic.hex(), fname, pos)
+                    )
+                inLen = struct.unpack_from("<I", mm, pos + 4)[0]
+                size = BLOCK_RECORD_PREFIX_SIZE + inLen
+                if pos + size > end:
+                    # Truncated by an unclean shutdown
+                    break
+                blk = pos + BLOCK_RECORD_PREFIX_SIZE
+                hdr_size = get_blk_hdr_size(mm, blk)
+                hashes.append(calc_hdr_hash(mm[blk : blk + hdr_size]))
+                offsets.append(pos)
+                sizes.append(size)
+                pos += size
+    return b"".join(hashes), offsets, sizes
+
+
+class BlockIndex:
+    """Location of every block of the hash list in the input blk*.dat files.
+
+    Entries are stored in flat arrays indexed by height, so the index for a
+    chain of millions of blocks takes a few tens of megabytes."""
+
+    def __init__(self, nblocks):
+        self.fn = array("i", [-1]) * nblocks
+        self.offset = array("Q", [0]) * nblocks
+        self.size = array("Q", [0]) * nblocks
+        self.blkCountIn = 0
+
+    def add_file(self, fn, blkmap, hashes, offsets, sizes, debug_output):
+        for i in range(len(offsets)):
+            hash_str = hashes[i * 32 : (i + 1) * 32][::-1].hex()
+            height = blkmap.get(hash_str)
+            if height is None:
+                # Blocks are written to files out-of-order and stale blocks
+                # are kept, so the index can contain blocks we don't know about.
+                if debug_output:
+                    print("Skipping unknown block " + hash_str)
+                continue
+            self.fn[height] = fn
+            self.offset[height] = offsets[i]
+            self.size[height] = sizes[i]
+            self.blkCountIn += 1
+
+    def find_missing(self):
+        """Return the lowest height without a block, or None."""
+        for height, fn in enumerate(self.fn):
+            if fn < 0:
+                return height
+        return None
+
+
+def build_block_index(settings, blkmap, nblocks):
+    """Scan all input files in parallel and index the blocks by height."""
+    fnames = []
+    while os.path.exists(inFileName(settings, len(fnames))):
+        fnames.append(inFileName(settings, len(fnames)))
+    print(
+        "Indexing %i input files with %i workers" % (len(fnames), settings["workers"])
+    )
+
+    index = BlockIndex(nblocks)
+    debug_output = settings["debug_output"] == "true"
+    with ProcessPoolExecutor(max_workers=settings["workers"]) as executor:
+        results = executor.map(
+            scan_block_file, fnames, [settings["netmagic"]] * len(fnames)
+        )
+        for fn, (hashes, offsets, sizes) in enumerate(results):
+            index.add_file(fn, blkmap, hashes, offsets, sizes, debug_output)
+    return index
 
 
 class BlockDataCopier:
-    def __init__(self, settings, blkindex, blkmap):
+    def __init__(self, settings, blkindex, index):
         self.settings = settings
         self.blkindex = blkindex
-        self.blkmap = blkmap
+        self.index = index
 
-        self.inFn = 0
-        self.inF = None
+        self.inFiles = OrderedDict()
         self.outFn = 0
         self.outsz = 0
         self.outF = None
         self.outFname = None
-        self.blkCountIn = 0
         self.blkCountOut = 0
 
         self.lastDate = datetime.datetime(2000, 1, 1)
@@ -140,13 +219,9 @@ class BlockDataCopier:
             self.setFileTime = True
         if settings["split_timestamp"] != 0:
             self.timestampSplit = True
-        # Extents and cache for out-of-order blocks
-        self.blockExtents = {}
-        self.outOfOrderData = {}
-        self.outOfOrderSize = 0  # running total size for items in outOfOrderData
 
-    def writeBlock(self, inhdr, blk_hdr, rawblock):
-        blockSizeOnDisk = len(inhdr) + len(blk_hdr) + len(rawblock)
+    def writeBlock(self, record):
+        blockSizeOnDisk = len(record)
         if not self.fileOutput and ((self.outsz + blockSizeOnDisk) > self.maxOutSz):
             self.outF.close()
             if self.setFileTime:
@@ -156,9 +231,14 @@ class BlockDataCopier:
             self.outFn = self.outFn + 1
             self.outsz = 0
 
-        (blkDate, blkTS) = get_blk_dt(blk_hdr)
+        blkDate, blkTS = get_blk_dt(record[BLOCK_RECORD_PREFIX_SIZE:])
         if self.timestampSplit and (blkDate > self.lastDate):
-            print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.hash_str)
+            print(
+                "New month "
+                + blkDate.strftime("%Y-%m")
+                + " @ "
+                + self.blkindex[self.blkCountOut]
+            )
             self.lastDate = blkDate
             if self.outF:
                 self.outF.close()
@@ -179,10 +259,8 @@ class BlockDataCopier:
             print("Output file " + self.outFname)
             self.outF = open(self.outFname, "wb")
 
-        self.outF.write(inhdr)
-        self.outF.write(blk_hdr)
-        self.outF.write(rawblock)
-        self.outsz = self.outsz + len(inhdr) + len(blk_hdr) + len(rawblock)
+        self.outF.write(record)
+        self.outsz = self.outsz + blockSizeOnDisk
 
         self.blkCountOut = self.blkCountOut + 1
         if blkTS > self.highTS:
@@ -192,93 +270,46 @@ class BlockDataCopier:
             print(
                 "%i blocks scanned, %i blocks written (of %i, %.1f%% complete)"
                 % (
-                    self.blkCountIn,
+                    self.index.blkCountIn,
                     self.blkCountOut,
                     len(self.blkindex),
                     100.0 * self.blkCountOut / len(self.blkindex),
                 )
             )
 
-    def inFileName(self, fn):
-        return os.path.join(self.settings["input"], "blk%05d.dat" % fn)
-
-    def fetchBlock(self, extent):
-        """Fetch block contents from disk given extents"""
-        with open(self.inFileName(extent.fn), "rb") as f:
-            f.seek(extent.offset)
-            return f.read(extent.size)
-
-    def copyOneBlock(self):
-        """Find the next block to be written in the input, and copy it to the output."""
-        extent = self.blockExtents.pop(self.blkCountOut)
-        if self.blkCountOut in self.outOfOrderData:
-            # If the data is cached, use it from memory and remove from the cache
-            rawblock = self.outOfOrderData.pop(self.blkCountOut)
-            self.outOfOrderSize -= len(rawblock)
-        else:  # Otherwise look up data on disk
-            rawblock = self.fetchBlock(extent)
-
-        self.writeBlock(extent.inhdr, extent.blkhdr, rawblock)
+    def inFile(self, fn):
+        """Return the memory-mapped input file fn, keeping a few of them open."""
+        if fn in self.inFiles:
+            self.inFiles.move_to_end(fn)
+            return self.inFiles[fn]
+        if len(self.inFiles) >= MAX_OPEN_INPUT_FILES:
+            self.inFiles.popitem(last=False)[1].close()
+        fname = inFileName(self.settings, fn)
+        print("Input file " + fname)
+        with open(fname, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.inFiles[fn] = mm
+        return mm
 
     def run(self):
-        while self.blkCountOut < len(self.blkindex):
-            if not self.inF:
-                fname = self.inFileName(self.inFn)
-                print("Input file " + fname)
-                try:
-                    self.inF = open(fname, "rb")
-                except IOError:
-                    print("Premature end of block data")
-                    return
-
-            inhdr = self.inF.read(8)
-            if not inhdr or (inhdr[0] == "\0"):
-                self.inF.close()
-                self.inF = None
-                self.inFn = self.inFn + 1
-                continue
-
-            inMagic = inhdr[:4]
-            if inMagic != self.settings["netmagic"]:
-                print("Invalid magic: " + inMagic.hex())
-                return
-            inLenLE = inhdr[4:]
-            su = struct.unpack("<I", inLenLE)
-            inLen = su[0] - 80  # length without header
-            blk_hdr = self.inF.read(80)
-            inExtent = BlockExtent(self.inFn, self.inF.tell(), inhdr, blk_hdr, inLen)
-
-            self.hash_str = calc_hash_str(blk_hdr)
-            if not self.hash_str in blkmap:
-                # Because blocks can be written to files out-of-order as of 0.10, the script
-                # may encounter blocks it doesn't know about. Treat as debug output.
-                if settings["debug_output"] == "true":
-                    print("Skipping unknown block " + self.hash_str)
-                self.inF.seek(inLen, os.SEEK_CUR)
-                continue
-
-            blkHeight = self.blkmap[self.hash_str]
-            self.blkCountIn += 1
-
-            if self.blkCountOut == blkHeight:
-                # If in-order block, just copy
-                rawblock = self.inF.read(inLen)
-                self.writeBlock(inhdr, blk_hdr, rawblock)
-
-                # See if we can catch up to prior out-of-order blocks
-                while self.blkCountOut in self.blockExtents:
-                    self.copyOneBlock()
-
-            else:  # If out-of-order, skip over block data for now
-                self.blockExtents[blkHeight] = inExtent
-                if self.outOfOrderSize < self.settings["out_of_order_cache_sz"]:
-                    # If there is space in the cache, read the data
-                    # Reading the data in file sequence instead of seeking and fetching it later is preferred,
-                    # but we don't want to fill up memory
-                    self.outOfOrderData[blkHeight] = self.inF.read(inLen)
-                    self.outOfOrderSize += inLen
-                else:  # If no space in cache, seek forward
-                    self.inF.seek(inLen, os.SEEK_CUR)
+        index = self.index
+        end = index.find_missing()
+        if end is not None:
+            print("Premature end of block data: block %i not found" % end)
+        else:
+            end = len(self.blkindex)
+
+        for height in range(end):
+            mm = self.inFile(index.fn[height])
+            offset = index.offset[height]
+            self.writeBlock(mm[offset : offset + index.size[height]])
+
+        if self.outF:
+            self.outF.close()
+            if self.setFileTime:
+                os.utime(self.outFname, (int(time.time()), self.highTS))
+        for mm in self.inFiles.values():
+            mm.close()
 
         print("Done (%i blocks written)" % (self.blkCountOut))
 
@@ -312,7 +343,7 @@ if __name__ == "__main__":
         settings["netmagic"] = "f9beb4d9"
     if "genesis" not in settings:
         settings["genesis"] = (
-            "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f"
+            "279b1a87aedc7b9471d4ad4e5f12967ab6259926cd097ade188dfcf22ebfe72a"
         )
     if "input" not in settings:
         settings["input"] = "input"
@@ -324,8 +355,8 @@ if __name__ == "__main__":
         settings["split_timestamp"] = 0
     if "max_out_sz" not in settings:
         settings["max_out_sz"] = 1000 * 1000 * 1000
-    if "out_of_order_cache_sz" not in settings:
-        settings["out_of_order_cache_sz"] = 100 * 1000 * 1000
+    if "workers" not in settings:
+        settings["workers"] = os.cpu_count() or 1
     if "debug_output" not in settings:
         settings["debug_output"] = "false"
 
@@ -333,7 +364,7 @@ if __name__ == "__main__":
     settings["split_timestamp"] = int(settings["split_timestamp"])
     settings["file_timestamp"] = int(settings["file_timestamp"])
     settings["netmagic"] = unhexlify(settings["netmagic"].encode("utf-8"))
-    settings["out_of_order_cache_sz"] = int(settings["out_of_order_cache_sz"])
+    settings["workers"] = int(settings["workers"])
     settings["debug_output"] = settings["debug_output"].lower()
 
     if "output_file" not in settings and "output" not in settings:
@@ -347,4 +378,5 @@ if __name__ == "__main__":
     if not settings["genesis"] in blkmap:
         print("Genesis block not found in hashlist")
     else:
-        BlockDataCopier(settings, blkindex, blkmap).run()
+        index = build_block_index(settings, blkmap, len(blkindex))
+        BlockDataCopier(settings, blkindex, index).run()
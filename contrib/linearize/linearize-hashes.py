@@ -7,13 +7,17 @@
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 #
 
-from http.client import HTTPConnection
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
 import json
 import re
 import base64
 import sys
 import os
 import os.path
+import threading
+import time
 
 settings = {}
 
@@ -44,12 +48,11 @@ class DefiRPC:
                 "RPC connection refused. Check RPC settings and the server status.",
                 file=sys.stderr,
             )
-            return None
+            raise
 
         resp = self.conn.getresponse()
         if resp is None:
-            print("JSON-RPC: no response", file=sys.stderr)
-            return None
+            raise HTTPException("JSON-RPC: no response")
 
         body = resp.read().decode("utf-8")
         resp_obj = json.loads(body)
@@ -69,39 +72,145 @@ class DefiRPC:
         return "error" in resp_obj and resp_obj["error"] is not None
 
 
-def get_block_hashes(settings, max_blocks_per_call=10000):
-    rpc = DefiRPC(
-        settings["host"], settings["port"], settings["rpcuser"], settings["rpcpassword"]
-    )
+class BlockHashFetcher:
+    """Fetch batches of block hashes over a pool of RPC connections."""
 
-    height = settings["min_height"]
-    while height < settings["max_height"] + 1:
-        num_blocks = min(settings["max_height"] + 1 - height, max_blocks_per_call)
+    def __init__(self, settings):
+        self.settings = settings
+        self.local = threading.local()
+
+    def rpc(self):
+        if not hasattr(self.local, "rpc"):
+            self.local.rpc = DefiRPC(
+                self.settings["host"],
+                self.settings["port"],
+                self.settings["rpcuser"],
+                self.settings["rpcpassword"],
+            )
+        return self.local.rpc
+
+    def fetch(self, height, num_blocks):
+        """Return the hashes of num_blocks blocks starting at height."""
         batch = []
         for x in range(num_blocks):
-            batch.append(rpc.build_request(x, "getblockhash", [height + x]))
+            batch.append(DefiRPC.build_request(x, "getblockhash", [height + x]))
 
-        reply = rpc.execute(batch)
-        if reply is None:
-            print("Cannot continue. Program will halt.")
-            return None
-
-        for x, resp_obj in enumerate(reply):
-            if rpc.response_is_error(resp_obj):
+        for attempt in range(self.settings["retries"] + 1):
+            try:
+                reply = self.rpc().execute(batch)
+                break
+            except (OSError, HTTPException, ValueError) as e:
+                # Start over on a fresh connection. ValueError is a malformed
+                # JSON body.
+                del self.local.rpc
                 print(
-                    "JSON-RPC: error at height",
-                    height + x,
-                    ": ",
-                    resp_obj["error"],
+                    "JSON-RPC: batch at height %d failed (%s), attempt %d"
+                    % (height, e, attempt + 1),
                     file=sys.stderr,
                 )
-                sys.exit(1)
+                if attempt < self.settings["retries"]:
+                    time.sleep(min(2**attempt, 30))
+        else:
+            raise RuntimeError("Cannot fetch hashes at height %d" % height)
+
+        if not isinstance(reply, list):
+            raise RuntimeError("JSON-RPC: unexpected reply at height %d" % height)
+        hashes = []
+        for x, resp_obj in enumerate(reply):
+            if DefiRPC.response_is_error(resp_obj):
+                raise RuntimeError(
+                    "JSON-RPC: error at height %d: %s" % (height + x, resp_obj["error"])
+                )
             assert resp_obj["id"] == x  # assume replies are in-sequence
-            if settings["rev_hash_bytes"] == "true":
+            if self.settings["rev_hash_bytes"] == "true":
                 resp_obj["result"] = hex_switchEndian(resp_obj["result"])
-            print(resp_obj["result"])
+            hashes.append(resp_obj["result"])
+        return hashes
 
-        height += num_blocks
+
+def open_output(settings):
+    """Open the output file and return it with the first height to fetch.
+
+    Hashes already in the output file are kept, so an interrupted export
+    resumes after the last complete line."""
+    if "hashlist_output" not in settings:
+        return sys.stdout, settings["min_height"]
+    f = open(settings["hashlist_output"], "a+b")
+    f.seek(0)
+    count = 0
+    complete = 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        count += 1
+        complete += len(line)
+    # Drop a partially written last line
+    f.truncate(complete)
+    f.seek(complete)
+    if count:
+        print(
+            "Resuming after %d hashes in %s" % (count, settings["hashlist_output"]),
+            file=sys.stderr,
+        )
+    return f, settings["min_height"] + count
+
+
+def get_block_hashes(settings, max_blocks_per_call=None):
+    if max_blocks_per_call is None:
+        max_blocks_per_call = settings["batch_size"]
+    out, height = open_output(settings)
+    end = settings["max_height"] + 1
+    fetcher = BlockHashFetcher(settings)
+
+    start_height = height
+    start_time = time.time()
+    last_report = start_time
+    pending = deque()
+    max_pending = 2 * settings["connections"]
+    try:
+        with ThreadPoolExecutor(max_workers=settings["connections"]) as executor:
+            next_height = height
+            while height < end:
+                # Keep the connections busy while results are written in order
+                while next_height < end and len(pending) < max_pending:
+                    num_blocks = min(end - next_height, max_blocks_per_call)
+                    pending.append(
+                        executor.submit(fetcher.fetch, next_height, num_blocks)
+                    )
+                    next_height += num_blocks
+
+                try:
+                    hashes = pending.popleft().result()
+                except RuntimeError as e:
+                    print(e, file=sys.stderr)
+                    print("Cannot continue. Program will halt.", file=sys.stderr)
+                    for future in pending:
+                        future.cancel()
+                    return None
+
+                lines = "".join(h + "\n" for h in hashes)
+                if out is sys.stdout:
+                    out.write(lines)
+                else:
+                    out.write(lines.encode())
+                out.flush()
+                height += len(hashes)
+
+                now = time.time()
+                if now - last_report >= 10 or height == end:
+                    print(
+                        "Height %d, %.0f blocks/s"
+                        % (
+                            height - 1,
+                            (height - start_height) / max(now - start_time, 1e-3),
+                        ),
+                        file=sys.stderr,
+                    )
+                    last_report = now
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return height
 
 
 def get_rpc_cookie():
@@ -146,6 +255,12 @@ if __name__ == "__main__":
         settings["max_height"] = 313000
     if "rev_hash_bytes" not in settings:
         settings["rev_hash_bytes"] = "false"
+    if "connections" not in settings:
+        settings["connections"] = 4
+    if "batch_size" not in settings:
+        settings["batch_size"] = 2000
+    if "retries" not in settings:
+        settings["retries"] = 3
 
     use_userpass = True
     use_datadir = False
@@ -162,6 +277,9 @@ if __name__ == "__main__":
     settings["port"] = int(settings["port"])
     settings["min_height"] = int(settings["min_height"])
     settings["max_height"] = int(settings["max_height"])
+    settings["connections"] = int(settings["connections"])
+    settings["batch_size"] = int(settings["batch_size"])
+    settings["retries"] = int(settings["retries"])
 
     # Force hash byte format setting to be lowercase to make comparisons easier.
     settings["rev_hash_bytes"] = settings["rev_hash_bytes"].lower()
@@ -170,4 +288,5 @@ if __name__ == "__main__":
     if use_datadir:
         get_rpc_cookie()
 
-    get_block_hashes(settings)
+    if get_block_hashes(settings) is None:
+        sys.exit(1)
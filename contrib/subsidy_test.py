@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
-import sys
+"""Compute the DeFi coin supply at arbitrary block heights.
 
-if len(sys.argv) != 2:
-    print("Usage: {} <height>".format(sys.argv[0]))
-    sys.exit(1)
+Post-Eunos, the block subsidy only changes once per emission reduction
+period, so the cumulative subsidy is tabulated per period and the supply at
+any height is one table lookup plus one multiplication. Amounts are integer
+satoshis and follow the rounding of GetBlockSubsidy in validation.cpp.
+
+Usage: subsidy_test.py <height> [<height> ...]
+       subsidy_test.py --table <step> <height>
+"""
+
+import argparse
 
 eunos_fork = 894000
 emission_reduction_interval = 32690
 emission_reduction_amount = 1658
 
 COIN = 100000000
+base_block_subsidy = 200 * COIN
+new_base_block_subsidy = 40504000000
+
 initial_masternodes = 1000010 * COIN  # 100m collateral + 10 creation fee
 initial_dist = 58800000 * COIN
 initial_dist += 44100000 * COIN
@@ -24,36 +34,91 @@ initial_dist += 117600000 * COIN
 foundation_burn = 26571399989000000
 foundation_burn += 287883508826675
 
-subsidy_reductions = {}
+initial_supply = 3 * initial_masternodes + initial_dist - foundation_burn
+
+
+def build_periods():
+    """Return the subsidy of each emission reduction period and the total
+    subsidy of all blocks before the period, up to the first period with a
+    zero subsidy."""
+    subsidies = []
+    cumulative = []
+    subsidy = new_base_block_subsidy
+    total = eunos_fork * base_block_subsidy
+    while True:
+        subsidies.append(subsidy)
+        cumulative.append(total)
+        if subsidy == 0:
+            return subsidies, cumulative
+        total += subsidy * emission_reduction_interval
+        reduction_amount = (subsidy * emission_reduction_amount) // 100000
+        if reduction_amount == 0:
+            subsidy = 0
+        else:
+            subsidy -= reduction_amount
+
+
+period_subsidies, period_cumulative = build_periods()
+
+
+def get_period(height):
+    """Index into the period tables for a post-Eunos height."""
+    reductions = (height - eunos_fork) // emission_reduction_interval
+    return min(reductions, len(period_subsidies) - 1)
 
 
 def get_subsidy(height):
-    base_subsidy = 200 * COIN
+    if height < eunos_fork:
+        return base_block_subsidy
+    return period_subsidies[get_period(height)]
+
+
+def get_cumulative_subsidy(height):
+    """Total subsidy of the blocks below height."""
+    if height <= eunos_fork:
+        return height * base_block_subsidy
+    period = get_period(height)
+    start = eunos_fork + period * emission_reduction_interval
+    return period_cumulative[period] + period_subsidies[period] * (height - start)
+
 
-    if height >= eunos_fork:
-        base_subsidy = 40504000000
-        reductions = int((height - eunos_fork) / emission_reduction_interval)
+def get_supply(height):
+    return initial_supply + get_cumulative_subsidy(height)
 
-        if reductions in subsidy_reductions:
-            return subsidy_reductions[reductions]
 
-        for _ in range(reductions, 0, -1):
-            reduction_amount = (base_subsidy * emission_reduction_amount) / 100000
-            if reduction_amount == 0:
-                return 0
+def get_supplies(heights):
+    """Supply at each of heights."""
+    return [get_supply(height) for height in heights]
 
-            base_subsidy -= reduction_amount
 
-        subsidy_reductions[reductions] = base_subsidy
+def supply_table(stop, step):
+    """Yield (height, subsidy, supply) every step blocks up to stop."""
+    for height in range(0, stop + 1, step):
+        yield height, get_subsidy(height), get_supply(height)
 
-    return base_subsidy
 
+def format_amount(amount):
+    return "{}.{:08d}".format(amount // COIN, amount % COIN)
 
-total_supply = 3 * initial_masternodes
-total_supply += initial_dist
-total_supply -= foundation_burn
 
-for i in range(int(sys.argv[1])):
-    total_supply += get_subsidy(i)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print the coin supply after the given number of blocks."
+    )
+    parser.add_argument("heights", type=int, nargs="+", metavar="height")
+    parser.add_argument(
+        "--table",
+        type=int,
+        metavar="STEP",
+        help="print height, subsidy and supply every STEP blocks up to height",
+    )
+    args = parser.parse_args()
 
-print(f"{total_supply / 1e8:.8f}")
+    if args.table:
+        for height, subsidy, supply in supply_table(max(args.heights), args.table):
+            print(height, format_amount(subsidy), format_amount(supply))
+    elif len(args.heights) == 1:
+        print(format_amount(get_supply(args.heights[0])))
+    else:
+        for height, supply in zip(args.heights, get_supplies(args.heights)):
+            print(height, format_amount(supply))
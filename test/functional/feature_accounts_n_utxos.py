@@ -10,7 +10,7 @@
 
 from test_framework.test_framework import DefiTestFramework
 from test_framework.authproxy import JSONRPCException
-from test_framework.fixture_util import CommonFixture
+from test_framework.fixture_util import ChainFixture, CommonFixture
 from test_framework.util import (
     assert_equal,
     assert_raises_rpc_error,
@@ -31,12 +31,13 @@ class AccountsAndUTXOsTest(DefiTestFramework):
             ["-txnotokens=0", "-amkheight=50"],
             ["-txnotokens=0", "-amkheight=50"],
         ]
+        self.chain_fixture = ChainFixture(
+            "default_tokens", CommonFixture.setup_default_tokens
+        )
 
     def run_test(self):
-        assert_equal(len(self.nodes[0].listtokens()), 1)  # only one token == DFI
-
-        print("Generating initial chain...")
-        CommonFixture.setup_default_tokens(self)
+        # Initial chain with GOLD and SILVER is restored from the chain fixture
+        assert_equal(len(self.nodes[0].listtokens()), 3)
 
         # Stop node #2 for future revert
         self.stop_node(2)
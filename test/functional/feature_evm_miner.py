@@ -4,7 +4,9 @@
 # Distributed under the MIT software license, see the accompanying
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 """Test EVM miner behaviour"""
+
 from test_framework.evm_contract import EVMContract
+from test_framework.evm_load import send_transactions
 from test_framework.test_framework import DefiTestFramework
 from test_framework.util import (
     assert_equal,
@@ -131,21 +133,20 @@ class EVMTest(DefiTestFramework):
             address=receipt["contractAddress"], abi=abi
         )
 
-        hashes = []
         start_nonce = self.nodes[0].w3.eth.get_transaction_count(self.ethAddress)
-        for i in range(40):
-            # tx call actual used gas: 1_761_626
-            tx = contract.functions.loop(10_000).build_transaction(
-                {
-                    "chainId": self.nodes[0].w3.eth.chain_id,
-                    "nonce": start_nonce + i,
-                    "gasPrice": 25_000_000_000,
-                    "gas": 30_000_000,
-                }
+        # tx call actual used gas: 1_761_626
+        tx = contract.functions.loop(10_000).build_transaction(
+            {
+                "gasPrice": 25_000_000_000,
+                "gas": 30_000_000,
+            }
+        )
+        hashes = [
+            hash.lower()[2:]
+            for hash in send_transactions(
+                self.nodes[0], self.ethPrivKey, [tx] * 40, nonce=start_nonce
             )
-            signed = self.nodes[0].w3.eth.account.sign_transaction(tx, self.ethPrivKey)
-            hash = self.nodes[0].w3.eth.send_raw_transaction(signed.rawTransaction)
-            hashes.append(signed.hash.hex().lower()[2:])
+        ]
 
         hash = self.nodes[0].eth_sendTransaction(
             {
@@ -625,23 +626,22 @@ class EVMTest(DefiTestFramework):
             address=receipt["contractAddress"], abi=abi
         )
 
-        hashes = []
         start_nonce = self.nodes[0].w3.eth.get_transaction_count(self.ethAddress)
         start_time = time()
         gas_price = 25_000_000_000
-        for i in range(64):
-            # tx call actual used gas: 1_761_626
-            tx = contract.functions.loop(10_000).build_transaction(
-                {
-                    "chainId": self.nodes[0].w3.eth.chain_id,
-                    "nonce": start_nonce + i,
-                    "gasPrice": gas_price,
-                    "gas": 30_000_000,
-                }
+        # tx call actual used gas: 1_761_626
+        tx = contract.functions.loop(10_000).build_transaction(
+            {
+                "gasPrice": gas_price,
+                "gas": 30_000_000,
+            }
+        )
+        hashes = [
+            hash.lower()[2:]
+            for hash in send_transactions(
+                self.nodes[0], self.ethPrivKey, [tx] * 64, nonce=start_nonce
             )
-            signed = self.nodes[0].w3.eth.account.sign_transaction(tx, self.ethPrivKey)
-            hash = self.nodes[0].w3.eth.send_raw_transaction(signed.rawTransaction)
-            hashes.append(signed.hash.hex().lower()[2:])
+        ]
 
         # Do valid RBF for nonce zero with incrementing fee
         for i in range(40):
@@ -10,7 +10,7 @@
 
 from test_framework.test_framework import DefiTestFramework
 from test_framework.authproxy import JSONRPCException
-from test_framework.fixture_util import CommonFixture
+from test_framework.fixture_util import ChainFixture, CommonFixture
 from test_framework.util import (
     connect_nodes,
     disconnect_nodes,
@@ -57,10 +57,11 @@ class GovsetTest(DefiTestFramework):
                 "-subsidytest=1",
             ],
         ]
+        self.chain_fixture = ChainFixture(
+            "default_tokens", CommonFixture.setup_default_tokens
+        )
 
     def run_test(self):
-        CommonFixture.setup_default_tokens(self)
-
         # Stop node #1 for future revert
         self.stop_node(1)
 
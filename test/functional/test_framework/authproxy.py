@@ -25,29 +25,50 @@ AuthServiceProxy has the following improvements over python-jsonrpc's
 ServiceProxy class:
 
 - HTTP connections persist for the life of the AuthServiceProxy object
-  (if server supports HTTP/1.1)
+  (if server supports HTTP/1.1), and are pooled so that the proxy can be
+  used from several threads at once
+- method proxies are cached, and can be awaited through the aio attribute
 - sends protocol 'version', per JSON-RPC 1.1
 - sends proper, incrementing 'id'
 - sends Basic HTTP authentication headers
 - parses all JSON numbers that look like floats as Decimal
-- uses standard Python json lib
+- uses standard Python json lib, or simplejson if selected (see JSONCodec)
 """
 
+import asyncio
 import base64
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import decimal
+import functools
 from http import HTTPStatus
 import http.client
+import http.server
+import itertools
 import json
 import logging
 import os
 import socket
+import tempfile
+import threading
 import time
+import timeit
+import unittest
 import urllib.parse
 
+try:
+    import simplejson
+except ImportError:  # Optional, faster JSON codec
+    simplejson = None
+
 from test_framework.tokenamount import TokenAmount
 
 HTTP_TIMEOUT = 30
 USER_AGENT = "AuthServiceProxy/0.1"
+# Idle HTTP connections kept open per RPC server
+POOL_SIZE = 8
+# Longest request or response text written to the DefiRPC debug log
+MAX_LOG_CHARS = 10000
 
 log = logging.getLogger("DefiRPC")
 
@@ -71,10 +92,158 @@ def EncodeDecimal(o):
     raise TypeError(repr(o) + " is not JSON serializable")
 
 
+def _log_text(data):
+    """Decode request or response bytes for the debug log."""
+    if len(data) > MAX_LOG_CHARS:
+        return "%s... (%d bytes)" % (
+            data[:MAX_LOG_CHARS].decode("utf8", "replace"),
+            len(data),
+        )
+    return data.decode("utf8", "replace")
+
+
+class RPCTrace:
+    """Writes one JSON line per RPC call to a file.
+
+    A record has the time the call was sent, the method ("batch" for a
+    batch of size calls), the request and response size in bytes, the
+    latency in seconds and the error code of a failed call: the JSON-RPC
+    error code, or the exception name if no response was received. For a
+    batch it is the list of error codes of the calls that failed. The file
+    is opened on the first write, and again after close()."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, **record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class JSONCodec:
+    """Encodes RPC requests and decodes RPC responses with the json module.
+
+    JSON numbers with a fraction or exponent are decoded as Decimal, so
+    amounts keep their exact value. Decimal and TokenAmount values in
+    requests are encoded as strings by EncodeDecimal. Responses are decoded
+    straight from the received bytes."""
+
+    name = "json"
+
+    def dumps(self, obj, ensure_ascii=True):
+        return json.dumps(obj, default=EncodeDecimal, ensure_ascii=ensure_ascii)
+
+    def encode(self, obj, ensure_ascii=True):
+        return self.dumps(obj, ensure_ascii).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data, parse_float=decimal.Decimal)
+
+
+class SimplejsonCodec(JSONCodec):
+    """JSONCodec using simplejson."""
+
+    name = "simplejson"
+
+    def __init__(self):
+        if simplejson is None:
+            raise ImportError("simplejson is not installed")
+
+    def dumps(self, obj, ensure_ascii=True):
+        # Keep the json module's handling of Decimal and namedtuple values
+        return simplejson.dumps(
+            obj,
+            default=EncodeDecimal,
+            ensure_ascii=ensure_ascii,
+            use_decimal=False,
+            namedtuple_as_object=False,
+        )
+
+    def decode(self, data):
+        return simplejson.loads(data, use_decimal=True)
+
+
+CODECS = {codec.name: codec for codec in [JSONCodec, SimplejsonCodec]}
+
+
+def available_codecs():
+    """Return an instance of each JSON codec that can be used."""
+    codecs = []
+    for codec in CODECS.values():
+        try:
+            codecs.append(codec())
+        except ImportError:
+            pass
+    return codecs
+
+
+# simplejson decodes float-heavy responses (listvaults, getblock) faster, but
+# is slower on string-heavy ones, so it is only used when selected.
+DEFAULT_CODEC = CODECS[os.getenv("DEFI_RPC_JSON_CODEC", "json")]()
+
+
+class ConnectionPool:
+    """Idle HTTP connections to one RPC server.
+
+    Every request takes a connection from the pool and puts it back once the
+    response has been read, so concurrent requests each get a connection of
+    their own. At most POOL_SIZE idle connections are kept open."""
+
+    def __init__(self, url, timeout, connection=None):
+        self.url = url
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        if connection:
+            self.timeout = connection.timeout
+            self._idle.append(connection)
+
+    def new(self):
+        port = 80 if self.url.port is None else self.url.port
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.url.hostname, port, timeout=self.timeout
+            )
+        return http.client.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.new()
+
+    def put(self, conn):
+        with self._lock:
+            if len(self._idle) < POOL_SIZE:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
 class AuthServiceProxy:
-    __id_count = 0
+    __id_count = itertools.count(1)
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
+    # codec: JSONCodec instance, DEFAULT_CODEC if None
+    # trace: RPCTrace to record every call to
     def __init__(
         self,
         service_url,
@@ -82,10 +251,14 @@ class AuthServiceProxy:
         timeout=HTTP_TIMEOUT,
         connection=None,
         ensure_ascii=True,
+        codec=None,
+        trace=None,
     ):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii  # can be toggled on the fly by tests
+        self.codec = DEFAULT_CODEC if codec is None else codec
+        self._trace = trace
         self.__url = urllib.parse.urlparse(service_url)
         user = (
             None if self.__url.username is None else self.__url.username.encode("utf8")
@@ -94,64 +267,106 @@ class AuthServiceProxy:
             None if self.__url.password is None else self.__url.password.encode("utf8")
         )
         authpair = user + b":" + passwd
-        self.__auth_header = b"Basic " + base64.b64encode(authpair)
-        # self.timeout = timeout
-        # @todo temp changed for debugging
-        self.timeout = 600
-        self._set_conn(connection)
+        self.__headers = {
+            "Host": self.__url.hostname,
+            "User-Agent": USER_AGENT,
+            "Authorization": b"Basic " + base64.b64encode(authpair),
+            "Content-type": "application/json",
+        }
+        self.__pool = ConnectionPool(self.__url, timeout, connection)
+        self.timeout = self.__pool.timeout
+        # Proxies created from this one share its connections and settings
+        self.__root = self
+        self.__proxies = {}
 
     def __getattr__(self, name):
         if name.startswith("__") and name.endswith("__"):
             # Python internal stuff
-            raise AttributeError
-        if self._service_name is not None:
-            name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+            raise AttributeError(name)
+        # Looked up in __dict__, so a proxy that isn't initialised (e.g. one
+        # being copied) doesn't recurse into __getattr__
+        proxies = self.__dict__.get("_AuthServiceProxy__proxies")
+        if proxies is None:
+            raise AttributeError(name)
+        proxy = proxies.get(name)
+        if proxy is None:
+            if self._service_name is not None:
+                service_name = "%s.%s" % (self._service_name, name)
+            else:
+                service_name = name
+            proxy = proxies[name] = self._child(service_name)
+        return proxy
+
+    def _child(self, service_name, service_url=None):
+        child = object.__new__(AuthServiceProxy)
+        child.__dict__.update(self.__dict__)
+        child._service_name = service_name
+        child.__proxies = {}
+        if service_url is not None:
+            child.__service_url = service_url
+            child.__url = urllib.parse.urlparse(service_url)
+        return child
+
+    def close(self):
+        """Close the idle connections of this proxy and its derived proxies."""
+        self.__pool.close()
+
+    @property
+    def aio(self):
+        """Awaitable view of this proxy, see AsyncAuthServiceProxy."""
+        return AsyncAuthServiceProxy(self)
+
+    @property
+    def _ensure_ascii(self):
+        return self.__root.ensure_ascii
 
     def _request(self, method, path, postdata):
         """
         Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
         This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+
+        Returns the decoded response, the HTTP status and the response size.
         """
-        headers = {
-            "Host": self.__url.hostname,
-            "User-Agent": USER_AGENT,
-            "Authorization": self.__auth_header,
-            "Content-type": "application/json",
-        }
         if os.name == "nt":
             # Windows somehow does not like to re-use connections
             # TODO: Find out why the connection would disconnect occasionally and make it reusable on Windows
-            self._set_conn()
+            conn = self.__pool.new()
+        else:
+            conn = self.__pool.get()
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except http.client.BadStatusLine as e:
-            if e.line == "''":  # if connection was closed, try again
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
-        except (BrokenPipeError, ConnectionResetError):
-            # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
-            # ConnectionResetError happens on FreeBSD with Python 3.4
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
+            try:
+                conn.request(method, path, postdata, self.__headers)
+                response = self._get_response(conn)
+            except http.client.BadStatusLine as e:
+                if e.line == "''":  # if connection was closed, try again
+                    conn.close()
+                    conn.request(method, path, postdata, self.__headers)
+                    response = self._get_response(conn)
+                else:
+                    raise
+            except (BrokenPipeError, ConnectionResetError):
+                # Python 3.5+ raises BrokenPipeError instead of BadStatusLine when the connection was reset
+                # ConnectionResetError happens on FreeBSD with Python 3.4
+                conn.close()
+                conn.request(method, path, postdata, self.__headers)
+                response = self._get_response(conn)
+        except BaseException:
+            # The connection may be in the middle of a response
+            conn.close()
+            raise
+        self.__pool.put(conn)
+        return response
 
     def get_request(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        request_id = next(AuthServiceProxy.__id_count)
 
-        log.debug(
-            "-{}-> {} {}".format(
-                AuthServiceProxy.__id_count,
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "-%s-> %s %s",
+                request_id,
                 self._service_name,
-                json.dumps(
-                    args or argsn, default=EncodeDecimal, ensure_ascii=self.ensure_ascii
-                ),
+                _log_text(self.codec.encode(args or argsn, self._ensure_ascii)),
             )
-        )
         if args and argsn:
             raise ValueError("Cannot handle both named and positional arguments")
         return {
@@ -159,18 +374,38 @@ class AuthServiceProxy:
             "jsonrpc": "2.0",
             "method": self._service_name,
             "params": args or argsn,
-            "id": AuthServiceProxy.__id_count,
+            "id": request_id,
         }
 
     def __call__(self, *args, **argsn):
-        postdata = json.dumps(
-            self.get_request(*args, **argsn),
-            default=EncodeDecimal,
-            ensure_ascii=self.ensure_ascii,
-        )
-        response, status = self._request(
-            "POST", self.__url.path, postdata.encode("utf-8")
+        postdata = self.codec.encode(
+            self.get_request(*args, **argsn), self._ensure_ascii
         )
+        start = time.time()
+        size = 0
+        error = None
+        try:
+            response, status, size = self._request("POST", self.__url.path, postdata)
+            return self._result(response, status)
+        except JSONRPCException as e:
+            error = e.error.get("code") if isinstance(e.error, dict) else None
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if self._trace is not None:
+                self._trace.write(
+                    time=start,
+                    method=self._service_name,
+                    request_bytes=len(postdata),
+                    response_bytes=size,
+                    latency=round(time.time() - start, 6),
+                    error=error,
+                )
+
+    @staticmethod
+    def _result(response, status):
         if "error" in response and response["error"] is not None:
             raise JSONRPCException(response["error"], status)
         elif "result" not in response:
@@ -189,34 +424,62 @@ class AuthServiceProxy:
             return response["result"]
 
     def batch(self, rpc_call_list):
-        postdata = json.dumps(
-            list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii
-        )
-        log.debug("--> " + postdata)
-        response, status = self._request(
-            "POST", self.__url.path, postdata.encode("utf-8")
-        )
-        if status != HTTPStatus.OK:
-            raise JSONRPCException(
-                {
-                    "code": -342,
-                    "message": "non-200 HTTP status code but no JSON-RPC error",
-                },
-                status,
-            )
-        return response
+        rpc_call_list = list(rpc_call_list)
+        postdata = self.codec.encode(rpc_call_list, self._ensure_ascii)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> %s", _log_text(postdata))
+        start = time.time()
+        size = 0
+        error = None
+        try:
+            response, status, size = self._request("POST", self.__url.path, postdata)
+            # The error codes of the calls that failed
+            responses = response if isinstance(response, list) else [response]
+            error = [
+                r["error"].get("code")
+                for r in responses
+                if isinstance(r.get("error"), dict)
+            ] or None
+            if status != HTTPStatus.OK:
+                raise JSONRPCException(
+                    {
+                        "code": -342,
+                        "message": "non-200 HTTP status code but no JSON-RPC error",
+                    },
+                    status,
+                )
+            return response
+        except JSONRPCException as e:
+            error = error or [
+                e.error.get("code") if isinstance(e.error, dict) else None
+            ]
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if self._trace is not None:
+                self._trace.write(
+                    time=start,
+                    method="batch",
+                    size=len(rpc_call_list),
+                    request_bytes=len(postdata),
+                    response_bytes=size,
+                    latency=round(time.time() - start, 6),
+                    error=error,
+                )
 
-    def _get_response(self):
+    def _get_response(self, conn):
         req_start_time = time.time()
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout:
             raise JSONRPCException(
                 {
                     "code": -344,
                     "message": "%r RPC took longer than %f seconds. Consider "
                     "using larger timeout for calls that take "
-                    "longer to return." % (self._service_name, self.__conn.timeout),
+                    "longer to return." % (self._service_name, conn.timeout),
                 }
             )
         if http_response is None:
@@ -235,43 +498,287 @@ class AuthServiceProxy:
                 http_response.status,
             )
 
-        responsedata = http_response.read().decode("utf8")
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
-        elapsed = time.time() - req_start_time
-        if "error" in response and response["error"] is None:
-            log.debug(
-                "<-%s- [%.6f] %s"
-                % (
-                    response["id"],
-                    elapsed,
-                    json.dumps(
-                        response["result"],
-                        default=EncodeDecimal,
-                        ensure_ascii=self.ensure_ascii,
-                    ),
+        responsedata = http_response.read()
+        response = self.codec.decode(responsedata)
+        if log.isEnabledFor(logging.DEBUG):
+            elapsed = time.time() - req_start_time
+            if "error" in response and response["error"] is None:
+                log.debug(
+                    "<-%s- [%.6f] %s", response["id"], elapsed, _log_text(responsedata)
                 )
-            )
-        else:
-            log.debug("<-- [%.6f] %s" % (elapsed, responsedata))
-        return response, http_response.status
+            else:
+                log.debug("<-- [%.6f] %s", elapsed, _log_text(responsedata))
+        return response, http_response.status, len(responsedata)
 
     def __truediv__(self, relative_uri):
-        return AuthServiceProxy(
-            "{}/{}".format(self.__service_url, relative_uri),
-            self._service_name,
-            connection=self.__conn,
+        return self._child(
+            self._service_name, "{}/{}".format(self.__service_url, relative_uri)
         )
 
-    def _set_conn(self, connection=None):
-        port = 80 if self.__url.port is None else self.__url.port
-        if connection:
-            self.__conn = connection
-            self.timeout = connection.timeout
-        elif self.__url.scheme == "https":
-            self.__conn = http.client.HTTPSConnection(
-                self.__url.hostname, port, timeout=self.timeout
+
+class AsyncAuthServiceProxy:
+    """Awaitable view of an RPC proxy.
+
+    ``await proxy.aio.getblockcount()`` runs the call in the event loop's
+    default executor. Each call in flight uses a pooled connection of its
+    own, so calls to one or several nodes can be gathered concurrently."""
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        if (
+            name.startswith("__")
+            and name.endswith("__")
+            or "_proxy" not in self.__dict__
+        ):
+            raise AttributeError(name)
+        return AsyncAuthServiceProxy(getattr(self._proxy, name))
+
+    def get_request(self, *args, **argsn):
+        return self._proxy.get_request(*args, **argsn)
+
+    async def _run(self, fn, *args, **argsn):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args, **argsn))
+
+    async def __call__(self, *args, **argsn):
+        return await self._run(self._proxy, *args, **argsn)
+
+    async def batch(self, rpc_call_list):
+        return await self._run(self._proxy.batch, list(rpc_call_list))
+
+
+class TestFrameworkAuthproxy(unittest.TestCase):
+    CONCURRENCY = 4
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if isinstance(request, list):
+                response = [self.call(r) for r in request]
+            else:
+                response = self.call(request)
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def call(self, request):
+            self.server.connections.add(self.client_address)
+            if request["method"] == "wait":
+                # Returns once CONCURRENCY calls are in flight at the same time
+                try:
+                    self.server.barrier.wait()
+                except threading.BrokenBarrierError:
+                    error = {"code": -1, "message": "calls were not concurrent"}
+                    return {"result": None, "error": error, "id": request["id"]}
+            if request["method"] == "fail":
+                error = {"code": -8, "message": "failed"}
+                return {"result": None, "error": error, "id": request["id"]}
+            return {"result": request["params"], "error": None, "id": request["id"]}
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        self.server.barrier = threading.Barrier(self.CONCURRENCY, timeout=5)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.proxy = AuthServiceProxy(
+            "http://u:p@127.0.0.1:%d" % self.server.server_port, timeout=5
+        )
+
+    def tearDown(self):
+        self.proxy.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_cached_proxies(self):
+        self.assertIs(self.proxy.echo, self.proxy.echo)
+        self.assertEqual(self.proxy.echo(1, "a"), [1, "a"])
+        self.assertEqual(self.proxy.echo(x=2), {"x": 2})
+        self.assertEqual(self.proxy.timeout, 5)
+        # Sequential calls reuse one connection
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_threads(self):
+        n = self.CONCURRENCY
+        with ThreadPoolExecutor(n) as executor:
+            results = list(executor.map(self.proxy.wait, range(n)))
+        self.assertEqual(results, [[i] for i in range(n)])
+        self.assertEqual(len(self.server.connections), n)
+
+    def test_async(self):
+        n = self.CONCURRENCY
+
+        async def gather():
+            return await asyncio.gather(*[self.proxy.aio.wait(i) for i in range(n)])
+
+        self.assertEqual(asyncio.run(gather()), [[i] for i in range(n)])
+        self.assertEqual(len(self.server.connections), n)
+        request = self.proxy.aio.echo.get_request(3)
+        results = asyncio.run(self.proxy.aio.batch([request]))
+        self.assertEqual(results[0]["result"], [3])
+
+    def test_getattr(self):
+        # Any name that isn't a dunder is an RPC method
+        self.assertEqual(self.proxy._private._service_name, "_private")
+        with self.assertRaises(AttributeError):
+            self.proxy.__deepcopy__
+        copied = copy.copy(self.proxy)
+        self.assertIs(copied.echo, self.proxy.echo)
+        self.assertEqual(copy.copy(self.proxy.aio).echo._proxy, self.proxy.echo)
+
+    def test_codecs(self):
+        data = '{"amount": 12345678.12345678, "n": 1, "ok": true, "s": "é"}'
+        request = {"amount": decimal.Decimal("0.1"), 1: "é"}
+        expected = JSONCodec().dumps(request)
+        for codec in available_codecs():
+            result = codec.decode(data.encode())
+            self.assertEqual(
+                result,
+                {
+                    "amount": decimal.Decimal("12345678.12345678"),
+                    "n": 1,
+                    "ok": True,
+                    "s": "é",
+                },
+                codec.name,
             )
-        else:
-            self.__conn = http.client.HTTPConnection(
-                self.__url.hostname, port, timeout=self.timeout
+            self.assertIs(type(result["amount"]), decimal.Decimal)
+            self.assertEqual(json.loads(codec.dumps(request)), json.loads(expected))
+            self.assertNotIn("é", codec.dumps(request))
+            self.assertIn("é", codec.dumps(request, ensure_ascii=False))
+
+    @unittest.skipUnless(os.getenv("DEFI_BENCH"), "set DEFI_BENCH=1 to run")
+    def test_bench_codecs(self):
+        """Measure decoding of large responses with each available codec."""
+        # Floats are encoded with their shortest repr, like amounts from defid
+        amount = 1234.56789012
+        responses = {
+            "listaccounthistory": [
+                {
+                    "owner": "bcrt1qyeuu9rvq8a67j86pzvh5897afdmdjpyankp4mu",
+                    "blockHeight": 1000 + i,
+                    "blockHash": "%064x" % i,
+                    "blockTime": 1700000000 + i,
+                    "type": "PoolSwap",
+                    "txn": i % 7,
+                    "txid": "%064x" % (i * 31),
+                    "amounts": ["-%s@DFI" % amount, "%s@BTC" % amount],
+                }
+                for i in range(5000)
+            ],
+            "listvaults": [
+                {
+                    "vaultId": "%064x" % i,
+                    "ownerAddress": "mwsZw8nF7pKxWH8eoKL9tPxTpaFkz7QeLU",
+                    "loanSchemeId": "LOAN150",
+                    "state": "active",
+                    "collateralAmounts": ["%s@DFI" % amount],
+                    "loanAmounts": ["%s@TSLA" % amount],
+                    "interestAmounts": ["0.00001234@TSLA"],
+                    "collateralValue": amount,
+                    "loanValue": amount,
+                    "interestValue": 0.00001234,
+                    "informativeRatio": 151.23456789,
+                    "collateralRatio": 151,
+                }
+                for i in range(5000)
+            ],
+            "getblock": {
+                "hash": "%064x" % 1,
+                "tx": [
+                    {
+                        "txid": "%064x" % i,
+                        "vin": [{"txid": "%064x" % i, "vout": 0, "sequence": 1}],
+                        "vout": [
+                            {
+                                "value": amount,
+                                "n": n,
+                                "scriptPubKey": {"hex": "0014" + "ab" * 20},
+                            }
+                            for n in range(2)
+                        ],
+                    }
+                    for i in range(3000)
+                ],
+            },
+            "debug_traceBlockByNumber": [
+                {
+                    "pc": i,
+                    "op": "PUSH1",
+                    "gas": 1000000 - i,
+                    "gasCost": 3,
+                    "depth": 1,
+                    "stack": ["0x%064x" % n for n in range(8)],
+                }
+                for i in range(5000)
+            ],
+        }
+        codecs = available_codecs()
+        print()
+        for method, result in responses.items():
+            data = json.dumps({"result": result, "error": None, "id": 1}).encode()
+            expected = JSONCodec().decode(data)
+            timings = []
+            for codec in codecs:
+                self.assertTrue(codec.decode(data) == expected, codec.name)
+                elapsed = min(
+                    timeit.repeat(lambda: codec.decode(data), number=1, repeat=5)
+                )
+                timings.append("{} {:.1f}ms".format(codec.name, elapsed * 1000))
+            print(
+                "{} ({} kB): {}".format(method, len(data) // 1000, ", ".join(timings))
+            )
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            trace = RPCTrace(os.path.join(tmpdir, "rpc_trace.jsonl"))
+            proxy = AuthServiceProxy(
+                "http://u:p@127.0.0.1:%d" % self.server.server_port, trace=trace
             )
+            proxy.echo("x" * 100)
+            proxy.batch([proxy.echo.get_request(1), proxy.echo.get_request(2)])
+            with self.assertRaises(JSONRPCException):
+                proxy.fail()
+            proxy.batch([proxy.fail.get_request(), proxy.echo.get_request(1)])
+            proxy.close()
+            trace.close()
+            # Closing the trace releases the file, a later call reopens it
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            unreachable = AuthServiceProxy(
+                "http://u:p@127.0.0.1:%d" % port, trace=trace
+            )
+            with self.assertRaises(OSError):
+                unreachable.echo()
+            trace.close()
+            with open(trace.path, encoding="utf8") as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(
+            [r["method"] for r in records], ["echo", "batch", "fail", "batch", "echo"]
+        )
+        self.assertGreater(records[0]["request_bytes"], 100)
+        self.assertGreater(records[0]["response_bytes"], 100)
+        self.assertEqual(records[1]["size"], 2)
+        self.assertEqual(
+            [r["error"] for r in records],
+            [None, None, -8, [-8], "ConnectionRefusedError"],
+        )
+
+    def test_log(self):
+        with self.assertLogs(log, logging.DEBUG) as logs:
+            self.proxy.echo("x" * (MAX_LOG_CHARS + 1))
+        self.assertEqual(len(logs.output), 2)
+        for line in logs.output:
+            self.assertLess(len(line), MAX_LOG_CHARS + 100)
+            self.assertIn("bytes)", line)
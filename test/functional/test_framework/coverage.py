@@ -8,11 +8,68 @@ Provides a way to track which RPC commands are exercised during
 testing.
 """
 
+import atexit
 import os
+import threading
+import time
+
+from .authproxy import AsyncAuthServiceProxy
 
 REFERENCE_FILENAME = "rpc_interface.txt"
 
 
+class CoverageLog:
+    """
+    Number of calls and total time per RPC method of one node.
+
+    Calls are counted in memory and written to the coverage file by
+    flush(), once at exit. Each line of the file is a method name, its call
+    count and the total time of its calls in seconds, separated by tabs.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, rpc_method, elapsed=0.0):
+        with self._lock:
+            count, total = self.calls.get(rpc_method, (0, 0.0))
+            self.calls[rpc_method] = (count + 1, total + elapsed)
+
+    def flush(self):
+        with self._lock:
+            calls = sorted(self.calls.items())
+        if not calls:
+            return
+        with open(self.filename, "w", encoding="utf8") as f:
+            f.writelines(
+                "%s\t%d\t%.6f\n" % (rpc_method, count, total)
+                for rpc_method, (count, total) in calls
+            )
+
+
+_coverage_logs = {}
+_coverage_logs_lock = threading.Lock()
+
+
+def get_coverage_log(filename):
+    """Return the CoverageLog writing to filename."""
+    with _coverage_logs_lock:
+        if filename not in _coverage_logs:
+            _coverage_logs[filename] = CoverageLog(filename)
+        return _coverage_logs[filename]
+
+
+@atexit.register
+def flush_coverage_logs():
+    with _coverage_logs_lock:
+        coverage_logs = list(_coverage_logs.values())
+    for coverage_log in coverage_logs:
+        coverage_log.flush()
+
+
 class AuthServiceProxyWrapper:
     """
     An object that wraps AuthServiceProxy to record specific RPC calls.
@@ -24,36 +81,55 @@ class AuthServiceProxyWrapper:
         Kwargs:
             auth_service_proxy_instance (AuthServiceProxy): the instance
                 being wrapped.
-            coverage_logfile (str): if specified, write each service_name
-                out to a file when called.
+            coverage_logfile (str): if specified, count the calls of each
+                service_name and write them out to this file at exit.
 
         """
         self.auth_service_proxy_instance = auth_service_proxy_instance
         self.coverage_logfile = coverage_logfile
+        self.coverage_log = (
+            get_coverage_log(coverage_logfile) if coverage_logfile else None
+        )
+        self._wrappers = {}
 
     def __getattr__(self, name):
+        if (
+            name.startswith("__")
+            and name.endswith("__")
+            or "_wrappers" not in self.__dict__
+        ):
+            raise AttributeError(name)
+        wrapper = self._wrappers.get(name)
+        if wrapper is not None:
+            return wrapper
         return_val = getattr(self.auth_service_proxy_instance, name)
         if not isinstance(return_val, type(self.auth_service_proxy_instance)):
             # If proxy getattr returned an unwrapped value, do the same here.
             return return_val
-        return AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        wrapper = self._wrappers[name] = AuthServiceProxyWrapper(
+            return_val, self.coverage_logfile
+        )
+        return wrapper
 
     def __call__(self, *args, **kwargs):
         """
-        Delegates to AuthServiceProxy, then writes the particular RPC method
-        called to a file.
+        Delegates to AuthServiceProxy, then records the particular RPC method
+        called and the time it took.
 
         """
+        start = time.perf_counter()
         return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
-        self._log_call()
+        self._log_call(time.perf_counter() - start)
         return return_val
 
-    def _log_call(self):
-        rpc_method = self.auth_service_proxy_instance._service_name
+    def _log_call(self, elapsed=0.0):
+        if self.coverage_log is not None:
+            rpc_method = self.auth_service_proxy_instance._service_name
+            self.coverage_log.record(rpc_method, elapsed)
 
-        if self.coverage_logfile:
-            with open(self.coverage_logfile, "a+", encoding="utf8") as f:
-                f.write("%s\n" % rpc_method)
+    @property
+    def aio(self):
+        return AsyncAuthServiceProxy(self)
 
     def __truediv__(self, relative_uri):
         return AuthServiceProxyWrapper(
@@ -61,15 +137,29 @@ class AuthServiceProxyWrapper:
         )
 
     def get_request(self, *args, **kwargs):
-        self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+    def batch(self, rpc_call_list):
+        """
+        Delegates to AuthServiceProxy, then records the RPC method of each
+        request with an equal share of the time the batch took.
+
+        """
+        rpc_call_list = list(rpc_call_list)
+        start = time.perf_counter()
+        return_val = self.auth_service_proxy_instance.batch(rpc_call_list)
+        if self.coverage_log is not None and rpc_call_list:
+            elapsed = (time.perf_counter() - start) / len(rpc_call_list)
+            for request in rpc_call_list:
+                self.coverage_log.record(request["method"], elapsed)
+        return return_val
+
 
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
 
-    This file will contain a list of RPC commands covered.
+    This file will contain the RPC commands covered, see CoverageLog.
     """
     pid = str(os.getpid())
     return os.path.join(dirname, "coverage.pid%s.node%s.txt" % (pid, str(n_node)))
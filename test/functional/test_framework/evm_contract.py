@@ -1,11 +1,32 @@
+import hashlib
+import json
 import os
+import tempfile
 from typing import List, Dict
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
 from solcx import compile_standard
 
 
+def _default_cache_dir():
+    """Compiled contracts are shared by all test runs on this machine.
+
+    Set EVM_CONTRACT_CACHE_DIR to use another directory, or to an empty
+    string to compile every time."""
+    cache_dir = os.environ.get("EVM_CONTRACT_CACHE_DIR")
+    if cache_dir is not None:
+        return cache_dir or None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "defi-functional-tests", "evm_contracts")
+
+
 class EVMContract:
     path_prefix = "../contracts"
+    cache_dir = _default_cache_dir()
 
     def __init__(
         self,
@@ -35,7 +56,7 @@ class EVMContract:
         return EVMContract(sourceCode, f"{contract_name}.sol", contract_name)
 
     def compile(self) -> (List[Dict], str):
-        compiled_sol = compile_standard(
+        compiled_sol = self._compile_cached(
             {
                 "language": "Solidity",
                 "sources": {self.file_name: {"content": self.code}},
@@ -44,8 +65,7 @@ class EVMContract:
                         "*": {"*": ["abi", "evm.bytecode", "evm.deployedBytecode"]}
                     }
                 },
-            },
-            solc_version=self.compiler_version,
+            }
         )
 
         data = compiled_sol["contracts"][self.file_name][self.contract_name]
@@ -54,3 +74,65 @@ class EVMContract:
         deployedBytecode = data["evm"]["deployedBytecode"]["object"]
 
         return abi, bytecode, deployedBytecode
+
+    def _compile_cached(self, input_data: Dict) -> Dict:
+        """Compile input_data, reusing the output of an identical compilation.
+
+        Outputs are stored under a hash of the compiler input and version.
+        Concurrent test processes take a lock per entry, so each source is
+        compiled only once."""
+        if not self.cache_dir:
+            return compile_standard(input_data, solc_version=self.compiler_version)
+
+        key = hashlib.sha256(
+            json.dumps([self.compiler_version, input_data], sort_keys=True).encode(
+                "utf8"
+            )
+        ).hexdigest()
+        path = os.path.join(self.cache_dir, key + ".json")
+
+        compiled_sol = self._read_cached(path)
+        if compiled_sol is not None:
+            return compiled_sol
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            lock = open(path + ".lock", "w", encoding="utf8")
+        except OSError:
+            # The cache directory is not writable, e.g. HOME is read-only
+            return compile_standard(input_data, solc_version=self.compiler_version)
+        with lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                except OSError:
+                    # No locking on this filesystem, at worst compile twice
+                    pass
+            # Another process may have compiled it while we were waiting
+            compiled_sol = self._read_cached(path)
+            if compiled_sol is None:
+                compiled_sol = compile_standard(
+                    input_data, solc_version=self.compiler_version
+                )
+                self._write_cached(path, compiled_sol)
+        return compiled_sol
+
+    def _write_cached(self, path: str, compiled_sol: Dict):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                json.dump(compiled_sol, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+
+    @staticmethod
+    def _read_cached(path: str):
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
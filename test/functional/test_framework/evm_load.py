@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Helpers for sending many EVM transactions to a node.
+
+Transactions are signed locally with sequential nonces, submitted to the
+node's EVM-RPC endpoint in a single JSON-RPC batch, and their receipts are
+polled with one batch per round. The server executes the calls of a batch in
+order, so nonce sequences arrive in order."""
+
+from concurrent.futures import ProcessPoolExecutor
+
+from eth_account import Account
+from web3 import Web3
+
+from .authproxy import JSONRPCException
+from .util import wait_until
+
+# Signing in worker processes only pays off for large batches
+PARALLEL_SIGNING_MIN_TXS = 256
+
+
+def _sign(privkey, tx):
+    signed = Account.sign_transaction(tx, privkey)
+    return Web3.to_hex(signed.rawTransaction), Web3.to_hex(signed.hash)
+
+
+def sign_transactions(node, privkey, txs, nonce=None, workers=None):
+    """Sign txs and return a list of (raw transaction, hash) hex strings.
+
+    Transactions without a nonce get sequential nonces starting at nonce,
+    which defaults to the sender's pending transaction count. A missing
+    chainId is looked up once for all transactions. Large batches are
+    signed in a pool of worker processes."""
+    if nonce is None:
+        address = Account.from_key(privkey).address
+        nonce = node.w3.eth.get_transaction_count(address, "pending")
+    chain_id = None
+    prepared = []
+    for tx in txs:
+        tx = dict(tx)
+        if "nonce" not in tx:
+            tx["nonce"] = nonce
+            nonce += 1
+        if "chainId" not in tx:
+            if chain_id is None:
+                chain_id = node.w3.eth.chain_id
+            tx["chainId"] = chain_id
+        prepared.append(tx)
+
+    if len(prepared) < PARALLEL_SIGNING_MIN_TXS or workers == 1:
+        return [_sign(privkey, tx) for tx in prepared]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(_sign, [privkey] * len(prepared), prepared, chunksize=64)
+        )
+
+
+def evm_batch(node, method, params_list):
+    """Call an EVM-RPC method once per params in a single JSON-RPC batch.
+
+    Returns the results in order and raises the first error."""
+    proxy = getattr(node.evm_rpc, method)
+    requests = [proxy.get_request(*params) for params in params_list]
+    if not requests:
+        return []
+    responses = {response["id"]: response for response in node.evm_rpc.batch(requests)}
+    results = []
+    for request in requests:
+        response = responses[request["id"]]
+        if response.get("error") is not None:
+            raise JSONRPCException(response["error"])
+        results.append(response.get("result"))
+    return results
+
+
+def send_raw_transactions(node, raw_txs):
+    """Submit raw transactions in one batch and return their hashes."""
+    return evm_batch(node, "eth_sendRawTransaction", [[raw] for raw in raw_txs])
+
+
+def send_transactions(node, privkey, txs, nonce=None, workers=None):
+    """Sign and submit txs, see sign_transactions. Returns their hashes."""
+    signed = sign_transactions(node, privkey, txs, nonce, workers)
+    return send_raw_transactions(node, [raw for raw, _ in signed])
+
+
+def get_transaction_receipts(node, tx_hashes):
+    """Fetch receipts in one batch. Pending transactions have no receipt (None)."""
+    return evm_batch(node, "eth_getTransactionReceipt", [[h] for h in tx_hashes])
+
+
+def wait_for_transaction_receipts(node, tx_hashes, timeout=60):
+    """Poll until all transactions have receipts and return them in order."""
+    receipts = {}
+
+    def all_mined():
+        pending = [h for h in tx_hashes if h not in receipts]
+        for tx_hash, receipt in zip(pending, get_transaction_receipts(node, pending)):
+            if receipt is not None:
+                receipts[tx_hash] = receipt
+        return len(receipts) == len(set(tx_hashes))
+
+    wait_until(all_mined, timeout=timeout)
+    return [receipts[h] for h in tx_hashes]
@@ -6,6 +6,8 @@
 """Fixture utility functions for containing common fixtures for functional testing. The fixture helper functions will
 by default always use nodes beginning from index 0 onwards."""
 
+import inspect
+
 from .test_framework import DefiTestFramework
 from .util import (
     assert_equal,
@@ -13,6 +15,28 @@ from .util import (
 )
 
 
+class ChainFixture:
+    """A named chain state that is built once and cached across test runs.
+
+    Assign an instance to `self.chain_fixture` in set_test_params() of a
+    setup_clean_chain test. `setup` is called with the test framework once
+    the network is up; the resulting datadirs are stored in --fixturedir,
+    which test_runner does not flush, and copied into later runs instead of
+    calling `setup` again. The cache key covers the defid binary, the test's
+    num_nodes and extra_args, and the source code of `setup` (but not of
+    the helpers it calls)."""
+
+    def __init__(self, name, setup):
+        self.name = name
+        self.setup = setup
+
+    def source(self):
+        try:
+            return inspect.getsource(self.setup)
+        except (OSError, TypeError):
+            return self.setup.__qualname__
+
+
 class CommonFixture:
     """Class for common utility fixture setup functions for function testing."""
 
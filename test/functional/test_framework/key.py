@@ -3,28 +3,27 @@
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 """Test-only secp256k1 elliptic curve implementation
 
+Key generation, signing and verification are dispatched to a system
+libsecp256k1 through ctypes when one is found (see load_libsecp256k1).
+
 WARNING: This code is slow, uses bad randomness, does not properly protect
 keys, and is trivially vulnerable to side channel attacks. Do not use for
 anything but tests."""
+
+import ctypes
+import ctypes.util
+import os
 import random
+import time
+import unittest
 
 
 def modinv(a, n):
-    """Compute the modular inverse of a modulo n
-
-    See https://en.wikipedia.org/wiki/Extended_Euclidean_algorithm#Modular_integers.
-    """
-    t1, t2 = 0, 1
-    r1, r2 = n, a
-    while r2 != 0:
-        q = r1 // r2
-        t1, t2 = t2, t1 - q * t2
-        r1, r2 = r2, r1 - q * r2
-    if r1 > 1:
+    """Compute the modular inverse of a modulo n, or None if it does not exist"""
+    try:
+        return pow(a, -1, n)
+    except ValueError:
         return None
-    if t1 < 0:
-        t1 += n
-    return t1
 
 
 def jacobi_symbol(n, k):
@@ -70,11 +69,17 @@ def modsqrt(a, p):
 
 
 class EllipticCurve:
+    # Window size in bits of the precomputed tables used by mul
+    WINDOW = 4
+
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        # Precomputed tables of fixed base points (see add_fixed_base)
+        self.fixed_bases = {}
+        self.fixed_base_bits = {}
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -217,18 +222,72 @@ class EllipticCurve:
         z3 = (h * z1 * z2) % self.p
         return (x3, y3, z3)
 
+    def add_fixed_base(self, p1, bits=256):
+        """Register the affine tuple p1 as a fixed base point for mul.
+
+        Precomputes d * 2^(WINDOW*i) * p1 in affine form for every window i
+        of a `bits`-bit scalar and every digit d, so that multiplying p1 by
+        such a scalar takes one mixed addition per window and no doublings.
+        The table is built on first use."""
+        self.fixed_bases[p1] = None
+        self.fixed_base_bits[p1] = bits
+
+    def _fixed_base_table(self, p1):
+        table = self.fixed_bases[p1]
+        if table is None:
+            table = []
+            base = p1
+            for _ in range(0, self.fixed_base_bits[p1], self.WINDOW):
+                row = [None, base]
+                for _ in range(2, 1 << self.WINDOW):
+                    row.append(self.affine(self.add_mixed(row[-1], base)))
+                table.append(row)
+                base = self.affine(self.add_mixed(row[-1], base))
+            self.fixed_bases[p1] = table
+        return table
+
+    def _window_table(self, p1):
+        """Return [infinity, p1, 2*p1, ...] up to (2^WINDOW - 1) * p1."""
+        row = [(0, 1, 0), p1]
+        for _ in range(2, 1 << self.WINDOW):
+            row.append(self.add(row[-1], p1))
+        return row
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
         ps is a list of (Jacobian tuple, scalar) pairs.
+
+        Fixed base points (see add_fixed_base) use their precomputed tables.
+        All other points are multiplied together with Strauss' algorithm:
+        one shared chain of doublings, with an addition from a small
+        per-point table for every non-zero WINDOW-bit digit.
         """
+        w = self.WINDOW
+        mask = (1 << w) - 1
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for p, n in ps:
-                if (n >> i) & 1:
-                    r = self.add(r, p)
-        return r
+        variable = []
+        for p, n in ps:
+            if p in self.fixed_bases and n.bit_length() <= self.fixed_base_bits[p]:
+                for row in self._fixed_base_table(p):
+                    if n & mask:
+                        r = self.add_mixed(r, row[n & mask])
+                    n >>= w
+            elif n:
+                variable.append((self._window_table(p), n))
+        if not variable:
+            return r
+
+        acc = (0, 1, 0)
+        windows = (max(n.bit_length() for _, n in variable) + w - 1) // w
+        for i in range(windows - 1, -1, -1):
+            for _ in range(w):
+                acc = self.double(acc)
+            for table, n in variable:
+                digit = (n >> (w * i)) & mask
+                if digit:
+                    acc = self.add(acc, table[digit])
+        return self.add(r, acc)
 
 
 SECP256K1 = EllipticCurve(2**256 - 2**32 - 977, 0, 7)
@@ -239,6 +298,94 @@ SECP256K1_G = (
 )
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+SECP256K1.add_fixed_base(SECP256K1_G)
+
+
+class LibSecp256k1:
+    """Minimal ctypes binding of the libsecp256k1 ECDSA API."""
+
+    # SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY
+    CONTEXT_FLAGS = (1 << 0) | (1 << 8) | (1 << 9)
+    EC_UNCOMPRESSED = 1 << 1
+
+    def __init__(self, path):
+        lib = ctypes.cdll.LoadLibrary(path)
+        lib.secp256k1_context_create.restype = ctypes.c_void_p
+        lib.secp256k1_context_create.argtypes = [ctypes.c_uint]
+        p, size_t, uint = ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint
+        for name, argtypes in [
+            ("secp256k1_ec_pubkey_create", [p, p, p]),
+            ("secp256k1_ec_pubkey_parse", [p, p, p, size_t]),
+            ("secp256k1_ec_pubkey_serialize", [p, p, p, p, uint]),
+            ("secp256k1_ecdsa_sign", [p, p, p, p, p, p]),
+            ("secp256k1_ecdsa_verify", [p, p, p, p]),
+            ("secp256k1_ecdsa_signature_parse_compact", [p, p, p]),
+            ("secp256k1_ecdsa_signature_normalize", [p, p, p]),
+            ("secp256k1_ecdsa_signature_serialize_der", [p, p, p, p]),
+        ]:
+            getattr(lib, name).argtypes = argtypes
+        self.lib = lib
+        self.ctx = lib.secp256k1_context_create(self.CONTEXT_FLAGS)
+        if not self.ctx:
+            raise OSError("secp256k1_context_create failed")
+
+    def pubkey_create(self, secret):
+        """Return the affine point secret * G."""
+        pubkey = ctypes.create_string_buffer(64)
+        assert self.lib.secp256k1_ec_pubkey_create(self.ctx, pubkey, secret)
+        out = ctypes.create_string_buffer(65)
+        outlen = ctypes.c_size_t(65)
+        self.lib.secp256k1_ec_pubkey_serialize(
+            self.ctx, out, ctypes.byref(outlen), pubkey, self.EC_UNCOMPRESSED
+        )
+        return (
+            int.from_bytes(out.raw[1:33], "big"),
+            int.from_bytes(out.raw[33:65], "big"),
+            1,
+        )
+
+    def sign(self, msg, secret, entropy):
+        """Return a DER-encoded low-S signature of the 32-byte msg."""
+        sig = ctypes.create_string_buffer(64)
+        assert self.lib.secp256k1_ecdsa_sign(self.ctx, sig, msg, secret, None, entropy)
+        der = ctypes.create_string_buffer(72)
+        derlen = ctypes.c_size_t(72)
+        self.lib.secp256k1_ecdsa_signature_serialize_der(
+            self.ctx, der, ctypes.byref(derlen), sig
+        )
+        return der.raw[: derlen.value]
+
+    def verify(self, pubkey, r, s, msg):
+        """Verify the signature (r, s) of the 32-byte msg, allowing high S."""
+        pk = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ec_pubkey_parse(self.ctx, pk, pubkey, len(pubkey)):
+            return False
+        sig = ctypes.create_string_buffer(64)
+        if not self.lib.secp256k1_ecdsa_signature_parse_compact(
+            self.ctx, sig, r.to_bytes(32, "big") + s.to_bytes(32, "big")
+        ):
+            return False
+        self.lib.secp256k1_ecdsa_signature_normalize(self.ctx, sig, sig)
+        return self.lib.secp256k1_ecdsa_verify(self.ctx, sig, msg, pk) == 1
+
+
+def load_libsecp256k1():
+    """Load libsecp256k1 from $LIBSECP256K1 or the system library path.
+
+    Returns None if the library is not available. Setting LIBSECP256K1 to
+    an empty string forces the pure Python implementation."""
+    path = os.getenv("LIBSECP256K1")
+    if path is None:
+        path = ctypes.util.find_library("secp256k1")
+    if not path:
+        return None
+    try:
+        return LibSecp256k1(path)
+    except (OSError, AttributeError):
+        return None
+
+
+libsecp256k1 = load_libsecp256k1()
 
 
 class ECPubKey:
@@ -339,6 +486,10 @@ class ECPubKey:
             return False
         if low_s and s >= SECP256K1_ORDER_HALF:
             return False
+        if libsecp256k1 is not None and len(msg) == 32:
+            pubkey = self.get_bytes()
+            if pubkey is not None:
+                return libsecp256k1.verify(pubkey, r, s, msg)
         z = int.from_bytes(msg, "big")
 
         # Run verifier algorithm on r, s
@@ -387,7 +538,10 @@ class ECKey:
         """Compute an ECPubKey object for this secret key."""
         assert self.valid
         ret = ECPubKey()
-        p = SECP256K1.mul([(SECP256K1_G, self.secret)])
+        if libsecp256k1 is not None:
+            p = libsecp256k1.pubkey_create(self.get_bytes())
+        else:
+            p = SECP256K1.mul([(SECP256K1_G, self.secret)])
         ret.p = p
         ret.valid = True
         ret.compressed = self.compressed
@@ -399,6 +553,10 @@ class ECKey:
         See https://en.wikipedia.org/wiki/Elliptic_Curve_Digital_Signature_Algorithm for the
         ECDSA signer algorithm."""
         assert self.valid
+        if libsecp256k1 is not None and low_s and len(msg) == 32:
+            # RFC6979 nonce with random extra entropy, so signatures still differ
+            entropy = random.getrandbits(256).to_bytes(32, "big")
+            return libsecp256k1.sign(msg, self.get_bytes(), entropy)
         z = int.from_bytes(msg, "big")
         # Note: no RFC6979, but a simple random nonce (some tests rely on distinct transactions for the same operation)
         k = random.randrange(1, SECP256K1_ORDER)
@@ -419,3 +577,88 @@ class ECKey:
             + bytes([2, len(sb)])
             + sb
         )
+
+
+class TestFrameworkKey(unittest.TestCase):
+    def backends(self):
+        """Run the loop body once per available backend of ECKey/ECPubKey."""
+        global libsecp256k1
+        lib = libsecp256k1
+        try:
+            for backend in [None] + ([lib] if lib is not None else []):
+                libsecp256k1 = backend
+                yield "python" if backend is None else "libsecp256k1"
+        finally:
+            libsecp256k1 = lib
+
+    def test_mul(self):
+        """Check mul against a plain double-and-add multiplication."""
+
+        def mul_reference(ps):
+            r = (0, 1, 0)
+            for i in range(255, -1, -1):
+                r = SECP256K1.double(r)
+                for p, n in ps:
+                    if (n >> i) & 1:
+                        r = SECP256K1.add(r, p)
+            return r
+
+        p1 = SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))])
+        for _ in range(10):
+            a = random.randrange(1, SECP256K1_ORDER)
+            b = random.randrange(1, SECP256K1_ORDER)
+            for ps in [
+                [(SECP256K1_G, a)],
+                [(p1, b)],
+                [(SECP256K1_G, a), (p1, b)],
+                [(SECP256K1_G, a), (SECP256K1_G, b)],
+            ]:
+                self.assertEqual(
+                    SECP256K1.affine(SECP256K1.mul(ps)),
+                    SECP256K1.affine(mul_reference(ps)),
+                )
+
+    def test_ecdsa(self):
+        """Sign and verify with every backend, and across backends."""
+        msg = random.getrandbits(256).to_bytes(32, "big")
+        signatures = []
+        for _ in self.backends():
+            key = ECKey()
+            key.set(bytes([1] * 32), True)
+            pubkey = key.get_pubkey()
+            self.assertEqual(
+                pubkey.get_bytes().hex(),
+                "031b84c5567b126440995d3ed5aaba0565d71e1834604819ff9c17f5e9d5dd078f",
+            )
+            sig = key.sign_ecdsa(msg)
+            self.assertTrue(pubkey.verify_ecdsa(sig, msg))
+            self.assertFalse(pubkey.verify_ecdsa(sig, bytes(32)))
+            # High-S signatures are only valid with low_s=False
+            r, s = sig[4 : 4 + sig[3]], int.from_bytes(sig[6 + sig[3] :], "big")
+            sb = (SECP256K1_ORDER - s).to_bytes(33, "big")
+            high_s = bytes([0x30, 4 + len(r) + len(sb), 2, len(r)]) + r
+            high_s += bytes([2, len(sb)]) + sb
+            self.assertFalse(pubkey.verify_ecdsa(high_s, msg))
+            self.assertTrue(pubkey.verify_ecdsa(high_s, msg, low_s=False))
+            signatures.append(sig)
+        for _ in self.backends():
+            for sig in signatures:
+                self.assertTrue(pubkey.verify_ecdsa(sig, msg))
+
+    @unittest.skipUnless(os.getenv("DEFI_BENCH"), "set DEFI_BENCH=1 to run")
+    def test_bench_ecdsa(self):
+        """Compare the speed of signing and verifying with every backend."""
+        msgs = [random.getrandbits(256).to_bytes(32, "big") for _ in range(20)]
+        for backend in self.backends():
+            key = ECKey()
+            key.generate()
+            pubkey = key.get_pubkey()
+            start = time.perf_counter()
+            for msg in msgs:
+                self.assertTrue(pubkey.verify_ecdsa(key.sign_ecdsa(msg), msg))
+            elapsed = time.perf_counter() - start
+            print(
+                "\n{}: {:.3f} ms per sign and verify".format(
+                    backend, elapsed * 1000 / len(msgs)
+                )
+            )
@@ -18,14 +18,16 @@ ser_*, deser_*: functions that handle serialization/deserialization.
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
-from codecs import encode
+
 import copy
 import hashlib
 from io import BytesIO
+import os
 import random
 import socket
 import struct
 import time
+import unittest
 
 from test_framework.siphash import siphash256
 from test_framework.util import hex_str_to_bytes, assert_equal
@@ -56,6 +58,13 @@ MSG_BLOCK = 2
 MSG_WITNESS_FLAG = 1 << 30
 MSG_TYPE_MASK = 0xFFFFFFFF >> 2
 
+UINT256_MASK = (1 << 256) - 1
+
+# Fixed-size part of a serialized block header, followed by the signature:
+# nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, stakeModifier,
+# nHeight, nMintedBlocks
+BLOCK_HEADER_STRUCT = struct.Struct("<i32s32sII32sQQ")
+
 
 # Serialization/deserialization tools
 def sha256(s):
@@ -100,27 +109,17 @@ def ser_string(s):
 
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return uint256_from_str(f.read(32))
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    if len(s) < 32:
+        raise struct.error("uint256 requires 32 bytes, got %d" % len(s))
+    return int.from_bytes(s[:32], "little")
 
 
 def uint256_from_compact(c):
@@ -143,13 +142,13 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    r = [ser_compact_size(len(l))]
     for i in l:
         if ser_function_name:
-            r += getattr(i, ser_function_name)()
+            r.append(getattr(i, ser_function_name)())
         else:
-            r += i.serialize()
-    return r
+            r.append(i.serialize())
+    return b"".join(r)
 
 
 def deser_uint256_vector(f):
@@ -162,10 +161,7 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return ser_compact_size(len(l)) + b"".join(ser_uint256(i) for i in l)
 
 
 def deser_string_vector(f):
@@ -178,10 +174,7 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    return ser_compact_size(len(l)) + b"".join(ser_string(sv) for sv in l)
 
 
 # Deserialize from a hex string representation (eg from RPC)
@@ -458,13 +451,10 @@ class CTxWitness:
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
-        for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+        return b"".join(x.serialize() for x in self.vtxinwit)
 
     def __repr__(self):
         return "CTxWitness(%s)" % (";".join([repr(x) for x in self.vtxinwit]))
@@ -520,35 +510,36 @@ class CTransaction:
         self.hash = None
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return b"".join(
+            (
+                struct.pack("<i", self.nVersion),
+                ser_vector(self.vin),
+                ser_vector(self.vout),
+                struct.pack("<I", self.nLockTime),
+            )
+        )
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = [struct.pack("<i", self.nVersion)]
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            r.append(ser_vector(dummy))
+            r.append(struct.pack("<B", flags))
+        r.append(ser_vector(self.vin))
+        r.append(ser_vector(self.vout))
         if flags & 1:
             if len(self.wit.vtxinwit) != len(self.vin):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[: len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            r.append(self.wit.serialize())
+        r.append(struct.pack("<I", self.nLockTime))
+        return b"".join(r)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
@@ -568,11 +559,10 @@ class CTransaction:
             # Don't cache the result, just return it
             return uint256_from_str(hash256(self.serialize_with_witness()))
 
+        txid = hash256(self.serialize_without_witness())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(
-            hash256(self.serialize_without_witness())[::-1], "hex_codec"
-        ).decode("ascii")
+            self.sha256 = uint256_from_str(txid)
+        self.hash = txid[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -641,51 +631,44 @@ class CBlockHeader:
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-
-        self.stakeModifier = deser_uint256(f)
-        self.nHeight = struct.unpack("<Q", f.read(8))[0]
-        self.nMintedBlocks = struct.unpack("<Q", f.read(8))[0]
+        (
+            self.nVersion,
+            hashPrevBlock,
+            hashMerkleRoot,
+            self.nTime,
+            self.nBits,
+            stakeModifier,
+            self.nHeight,
+            self.nMintedBlocks,
+        ) = BLOCK_HEADER_STRUCT.unpack(f.read(BLOCK_HEADER_STRUCT.size))
+        self.hashPrevBlock = uint256_from_str(hashPrevBlock)
+        self.hashMerkleRoot = uint256_from_str(hashMerkleRoot)
+        self.stakeModifier = uint256_from_str(stakeModifier)
         self.sig = deser_string(f)
 
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
+        return self.serialize_header()
 
-        r += ser_uint256(self.stakeModifier)
-        r += struct.pack("<Q", self.nHeight)
-        r += struct.pack("<Q", self.nMintedBlocks)
-        r += ser_string(self.sig)
-
-        return r
+    def serialize_header(self):
+        return BLOCK_HEADER_STRUCT.pack(
+            self.nVersion,
+            ser_uint256(self.hashPrevBlock),
+            ser_uint256(self.hashMerkleRoot),
+            self.nTime,
+            self.nBits,
+            ser_uint256(self.stakeModifier),
+            self.nHeight,
+            self.nMintedBlocks,
+        ) + ser_string(self.sig)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-
-            r += ser_uint256(self.stakeModifier)
-            r += struct.pack("<Q", self.nHeight)
-            r += struct.pack("<Q", self.nMintedBlocks)
-            r += ser_string(self.sig)
-
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], "hex_codec").decode("ascii")
+            h = hash256(self.serialize_header())
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
 
     def rehash(self):
         self.sha256 = None
@@ -725,13 +708,11 @@ class CBlock(CBlockHeader):
         self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += super(CBlock, self).serialize()
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            vtx = ser_vector(self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            vtx = ser_vector(self.vtx, "serialize_without_witness")
+        return self.serialize_header() + vtx
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -747,7 +728,9 @@ class CBlock(CBlockHeader):
     def calc_merkle_root(self):
         hashes = []
         for tx in self.vtx:
-            tx.calc_sha256()
+            # Transactions changed since their txid was cached must be rehashed
+            if tx.sha256 is None:
+                tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
         return self.get_merkle_root(hashes)
 
@@ -864,18 +847,19 @@ class P2PHeaderAndShortIDs:
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        r = [
+            self.header.serialize(),
+            struct.pack("<Q", self.nonce),
+            ser_compact_size(self.shortids_length),
+        ]
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            r.append(struct.pack("<Q", x)[0:6])
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            r.append(ser_vector(self.prefilled_txn, "serialize_with_witness"))
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            r.append(ser_vector(self.prefilled_txn, "serialize_without_witness"))
+        return b"".join(r)
 
     def __repr__(self):
         return (
@@ -1001,12 +985,10 @@ class BlockTransactionsRequest:
             self.indexes.append(deser_compact_size(f))
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        r = [ser_uint256(self.blockhash), ser_compact_size(len(self.indexes))]
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            r.append(ser_compact_size(x))
+        return b"".join(r)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -1657,3 +1639,59 @@ class msg_no_witness_blocktxn(msg_blocktxn):
 
     def serialize(self):
         return self.block_transactions.serialize(with_witness=False)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def _block(self, ntx):
+        block = CBlock()
+        block.hashPrevBlock = random.getrandbits(256)
+        block.nTime = 1600000000
+        block.nBits = 0x207FFFFF
+        block.stakeModifier = random.getrandbits(256)
+        block.nHeight = 101
+        block.nMintedBlocks = 7
+        for i in range(ntx):
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(random.getrandbits(256), i), b"\x51"))
+            tx.vout.append(CTxOut(i * COIN, b"\x51" * 22))
+            block.vtx.append(tx)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        return block
+
+    def test_block_roundtrip(self):
+        """Serialization must round-trip through the DeFi header layout."""
+        block = self._block(10)
+        data = block.serialize()
+        self.assertEqual(BLOCK_HEADER_STRUCT.size + 66, BLOCK_HEADER_SIZE)
+        decoded = CBlock()
+        decoded.deserialize(BytesIO(data))
+        decoded.rehash()
+        self.assertEqual(decoded.serialize(), data)
+        self.assertEqual(decoded.hash, block.hash)
+        self.assertEqual(decoded.calc_merkle_root(), block.hashMerkleRoot)
+        self.assertEqual(hash256(data[:BLOCK_HEADER_SIZE])[::-1].hex(), block.hash)
+
+    def test_merkle_root_uses_cached_txids(self):
+        """Changed transactions only affect the merkle root once rehashed."""
+        block = self._block(4)
+        root = block.hashMerkleRoot
+        block.vtx[1].nLockTime = 1
+        self.assertEqual(block.calc_merkle_root(), root)
+        block.vtx[1].rehash()
+        self.assertNotEqual(block.calc_merkle_root(), root)
+
+    @unittest.skipUnless(os.getenv("DEFI_BENCH"), "set DEFI_BENCH=1 to run")
+    def test_bench_build_block(self):
+        """Measure the time to grow, hash and serialize a large block."""
+        block = self._block(2000)
+        start = time.perf_counter()
+        for _ in range(20):
+            block.vtx.append(CTransaction(block.vtx[-1]))
+            block.vtx[-1].nLockTime += 1
+            block.vtx[-1].rehash()
+            block.hashMerkleRoot = block.calc_merkle_root()
+            block.solve()
+        size = len(block.serialize())
+        elapsed = time.perf_counter() - start
+        print("\n20 txs added to a {} byte block in {:.3f}s".format(size, elapsed))
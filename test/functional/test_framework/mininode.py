@@ -13,16 +13,21 @@ P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
 P2PDataStore: A p2p interface class that keeps a store of transactions and blocks
               and can respond correctly to getdata and getheaders messages"""
+
 import asyncio
 from collections import defaultdict
 from io import BytesIO
 import logging
+import os
 import struct
 import sys
 import threading
+import time
+import unittest
 
 from test_framework.messages import (
     CBlockHeader,
+    CInv,
     MIN_VERSION_SUPPORTED,
     msg_anchorauth,
     msg_addr,
@@ -90,6 +95,13 @@ MAGIC_BYTES = {
     "regtest": b"\xfa\xbf\xb5\xda",  # regtest
 }
 
+# magic, command, payload length, checksum
+MSG_HEADER = struct.Struct("<4s12si4s")
+
+# Consumed bytes are dropped from the front of the receive buffer once they
+# exceed this many bytes and half of the buffer
+RECVBUF_COMPACT_SIZE = 1 << 16
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -108,6 +120,13 @@ class P2PConnection(asyncio.Protocol):
         # The underlying transport of the connection.
         # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
         self._transport = None
+        # Frames waiting to be written by the NetworkThread. Frames queued
+        # before the loop gets to them are written with a single write().
+        self._send_lock = threading.Lock()
+        self._send_queue = []
+        # Serialized frames of payload objects that are re-sent unchanged,
+        # keyed by command and id(). Disabled when None, see build_message.
+        self.frame_cache = None
 
     @property
     def is_connected(self):
@@ -119,7 +138,10 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvpos = 0
+        with self._send_lock:
+            self._send_queue = []
         self.magic_bytes = MAGIC_BYTES[net]
         logger.debug("Connecting to Defi Node: %s:%d" % (self.dstaddr, self.dstport))
 
@@ -159,7 +181,8 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvpos = 0
         self.on_close()
 
     # Socket read methods
@@ -167,6 +190,12 @@ class P2PConnection(asyncio.Protocol):
     def data_received(self, t):
         """asyncio callback when data is read from the socket."""
         if len(t) > 0:
+            if self.recvpos == len(self.recvbuf):
+                self.recvbuf.clear()
+                self.recvpos = 0
+            elif self.recvpos > max(RECVBUF_COMPACT_SIZE, len(self.recvbuf) // 2):
+                del self.recvbuf[: self.recvpos]
+                self.recvpos = 0
             self.recvbuf += t
             self._on_data()
 
@@ -175,40 +204,48 @@ class P2PConnection(asyncio.Protocol):
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing.
+
+        Parsed messages are not removed from the buffer. Instead, recvpos is
+        advanced past them and data_received drops the consumed prefix in
+        bulk, so a read holding many messages is parsed in linear time."""
         try:
-            while True:
-                if len(self.recvbuf) < 4:
-                    return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError(
-                        "magic bytes mismatch: {} != {}".format(
-                            repr(self.magic_bytes), repr(self.recvbuf)
+            with memoryview(self.recvbuf) as view:
+                while True:
+                    pos = self.recvpos
+                    end = len(view)
+                    if end - pos < 4:
+                        return
+                    if view[pos : pos + 4] != self.magic_bytes:
+                        raise ValueError(
+                            "magic bytes mismatch: {} != {}".format(
+                                repr(self.magic_bytes), repr(bytes(view[pos:]))
+                            )
                         )
-                    )
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4 : 4 + 12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4 + 12 : 4 + 12 + 4])[0]
-                checksum = self.recvbuf[4 + 12 + 4 : 4 + 12 + 4 + 4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4 + 12 + 4 + 4 : 4 + 12 + 4 + 4 + msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4 + 12 + 4 + 4 + msglen :]
-                if command not in MESSAGEMAP:
-                    raise ValueError(
-                        "Received unknown command from %s:%d: '%s' %s"
-                        % (self.dstaddr, self.dstport, command, repr(msg))
-                    )
-                f = BytesIO(msg)
-                t = MESSAGEMAP[command]()
-                t.deserialize(f)
-                self._log_message("receive", t)
-                self.on_message(t)
+                    if end - pos < MSG_HEADER.size:
+                        return
+                    _, command, msglen, checksum = MSG_HEADER.unpack_from(view, pos)
+                    command = command.split(b"\x00", 1)[0]
+                    start = pos + MSG_HEADER.size
+                    if end - start < msglen:
+                        return
+                    payload = view[start : start + msglen]
+                    if checksum != sha256(sha256(payload))[:4]:
+                        raise ValueError("got bad checksum " + repr(bytes(view[pos:])))
+                    self.recvpos = start + msglen
+                    # The only copy of the payload. BytesIO shares the buffer
+                    # of a bytes object rather than copying it again.
+                    msg = payload.tobytes()
+                    payload.release()
+                    if command not in MESSAGEMAP:
+                        raise ValueError(
+                            "Received unknown command from %s:%d: '%s' %s"
+                            % (self.dstaddr, self.dstport, command, repr(msg))
+                        )
+                    t = MESSAGEMAP[command]()
+                    t.deserialize(BytesIO(msg))
+                    self._log_message("receive", t)
+                    self.on_message(t)
         except Exception as e:
             logger.exception("Error reading message:", repr(e))
             raise
@@ -219,32 +256,62 @@ class P2PConnection(asyncio.Protocol):
 
     # Socket write methods
 
-    def send_message(self, message):
+    def send_message(self, message, cache_key=None):
         """Send a P2P message over the socket.
 
         This method takes a P2P payload, builds the P2P header and adds
         the message to the send buffer to be sent over the socket."""
-        tmsg = self.build_message(message)
+        tmsg = self.build_message(message, cache_key)
         self._log_message("send", message)
         return self.send_raw_message(tmsg)
 
+    def send_messages(self, messages):
+        """Send several P2P messages over the socket with a single write."""
+        frames = []
+        for message in messages:
+            frames.append(self.build_message(message))
+            self._log_message("send", message)
+        return self.send_raw_message(b"".join(frames))
+
     def send_raw_message(self, raw_message_bytes):
         if not self.is_connected:
             raise IOError("Not connected")
 
-        def maybe_write():
-            if not self._transport:
-                return
-            if self._transport.is_closing():
+        with self._send_lock:
+            self._send_queue.append(raw_message_bytes)
+            if len(self._send_queue) > 1:
+                # A write is already scheduled and will pick this frame up.
                 return
-            self._transport.write(raw_message_bytes)
+        try:
+            NetworkThread.network_event_loop.call_soon_threadsafe(self._write_queued)
+        except Exception:
+            # No write is scheduled, so don't leave frames for one to pick up
+            with self._send_lock:
+                self._send_queue = []
+            raise
 
-        NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
+    def _write_queued(self):
+        """Write all queued frames. Must be called on the NetworkThread."""
+        with self._send_lock:
+            frames, self._send_queue = self._send_queue, []
+        if not self._transport:
+            return
+        if self._transport.is_closing():
+            return
+        self._transport.write(b"".join(frames))
 
     # Class utility methods
 
-    def build_message(self, message):
-        """Build a serialized P2P message"""
+    def build_message(self, message, cache_key=None):
+        """Build a serialized P2P message
+
+        If frame_cache is enabled and cache_key is given, the frame is built
+        once per cache_key object and reused while that object is alive. The
+        caller must not modify cache_key after the first send."""
+        if cache_key is not None and self.frame_cache is not None:
+            cached = self.frame_cache.get((message.command, id(cache_key)))
+            if cached is not None and cached[0] is cache_key:
+                return cached[1]
         command = message.command
         data = message.serialize()
         tmsg = self.magic_bytes
@@ -255,10 +322,15 @@ class P2PConnection(asyncio.Protocol):
         h = sha256(th)
         tmsg += h[:4]
         tmsg += data
+        if cache_key is not None and self.frame_cache is not None:
+            # Holding a reference keeps id(cache_key) from being reused.
+            self.frame_cache[(message.command, id(cache_key))] = (cache_key, tmsg)
         return tmsg
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -580,11 +652,13 @@ class P2PDataStore(P2PInterface):
             if (
                 inv.type & MSG_TYPE_MASK
             ) == MSG_TX and inv.hash in self.tx_store.keys():
-                self.send_message(msg_tx(self.tx_store[inv.hash]))
+                tx = self.tx_store[inv.hash]
+                self.send_message(msg_tx(tx), cache_key=tx)
             elif (
                 inv.type & MSG_TYPE_MASK
             ) == MSG_BLOCK and inv.hash in self.block_store.keys():
-                self.send_message(msg_block(self.block_store[inv.hash]))
+                block = self.block_store[inv.hash]
+                self.send_message(msg_block(block), cache_key=block)
             else:
                 logger.debug("getdata message type {} received.".format(hex(inv.type)))
 
@@ -654,8 +728,7 @@ class P2PDataStore(P2PInterface):
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
             if force_send:
-                for b in blocks:
-                    self.send_message(msg_block(block=b))
+                self.send_messages(msg_block(block=b) for b in blocks)
             else:
                 self.send_message(
                     msg_headers([CBlockHeader(block) for block in blocks])
@@ -695,8 +768,7 @@ class P2PDataStore(P2PInterface):
 
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
-            for tx in txs:
-                self.send_message(msg_tx(tx))
+            self.send_messages(msg_tx(tx) for tx in txs)
 
             if expect_disconnect:
                 self.wait_for_disconnect()
@@ -716,3 +788,113 @@ class P2PDataStore(P2PInterface):
                     assert tx.hash not in raw_mempool, "{} tx found in mempool".format(
                         tx.hash
                     )
+
+
+class TestFrameworkMininode(unittest.TestCase):
+    def _replay(self, stream, chunk_size):
+        """Feed a captured byte stream to a P2PConnection in chunk_size reads."""
+        received = []
+        conn = P2PConnection()
+        conn.dstaddr, conn.dstport = "127.0.0.1", 0
+        conn.magic_bytes = MAGIC_BYTES["regtest"]
+        conn.recvbuf = bytearray()
+        conn.recvpos = 0
+        conn.on_message = received.append
+        for i in range(0, len(stream), chunk_size):
+            conn.data_received(stream[i : i + chunk_size])
+        self.assertEqual(conn.recvpos, len(conn.recvbuf))
+        return received
+
+    def _capture(self):
+        conn = P2PConnection()
+        conn.magic_bytes = MAGIC_BYTES["regtest"]
+        messages = []
+        for i in range(2000):
+            messages.append(msg_ping(nonce=i))
+            messages.append(msg_inv([CInv(MSG_TX, (i << 8) + j) for j in range(50)]))
+        return messages, b"".join(conn.build_message(m) for m in messages)
+
+    def test_parse(self):
+        """Messages must survive any split of the stream into reads."""
+        messages, stream = self._capture()
+        messages = messages[:100]
+        stream = stream[: sum(MSG_HEADER.size + len(m.serialize()) for m in messages)]
+        expected = [m.serialize() for m in messages]
+        for chunk_size in [1, 23, 24, 1000, len(stream)]:
+            received = self._replay(stream, chunk_size)
+            self.assertEqual([m.serialize() for m in received], expected)
+
+    def _connection(self, writes):
+        """A P2PConnection whose transport appends the written bytes to writes."""
+
+        class Transport:
+            write = writes.append
+
+            def is_closing(self):
+                return False
+
+        conn = P2PConnection()
+        conn.dstaddr, conn.dstport = "127.0.0.1", 0
+        conn.magic_bytes = MAGIC_BYTES["regtest"]
+        conn.frame_cache = {}
+        conn._transport = Transport()
+        return conn
+
+    def test_send_coalesced(self):
+        """Frames queued between loop iterations go out in one write."""
+        writes = []
+        conn = self._connection(writes)
+        loop = asyncio.new_event_loop()
+        saved_loop, NetworkThread.network_event_loop = (
+            NetworkThread.network_event_loop,
+            loop,
+        )
+        try:
+            messages, _ = self._capture()
+            messages = messages[:10]
+            conn.send_message(messages[0], cache_key=messages[0])
+            conn.send_message(messages[0], cache_key=messages[0])
+            conn.send_messages(messages[1:])
+            loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            NetworkThread.network_event_loop = saved_loop
+            loop.close()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(len(conn.frame_cache), 1)
+        received = self._replay(writes[0], len(writes[0]))
+        self.assertEqual(
+            [m.serialize() for m in received],
+            [m.serialize() for m in messages[:1] + messages],
+        )
+
+    def test_send_loop_closed(self):
+        """Every send raises if the write cannot be scheduled."""
+        conn = self._connection([])
+        loop = asyncio.new_event_loop()
+        loop.close()
+        saved_loop, NetworkThread.network_event_loop = (
+            NetworkThread.network_event_loop,
+            loop,
+        )
+        try:
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    conn.send_raw_message(b"x")
+                self.assertEqual(conn._send_queue, [])
+        finally:
+            NetworkThread.network_event_loop = saved_loop
+
+    @unittest.skipUnless(os.getenv("DEFI_BENCH"), "set DEFI_BENCH=1 to run")
+    def test_bench_parse(self):
+        """Measure receive throughput for a replayed message stream."""
+        messages, stream = self._capture()
+        for chunk_size in [4096, 65536, len(stream)]:
+            start = time.perf_counter()
+            received = self._replay(stream, chunk_size)
+            elapsed = time.perf_counter() - start
+            self.assertEqual(len(received), len(messages))
+            print(
+                "\n{} byte reads: {:.1f} MB/s, {:.0f} msgs/s".format(
+                    chunk_size, len(stream) / elapsed / 1e6, len(messages) / elapsed
+                )
+            )
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Copyright (c) DeFi Blockchain Developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+"""Check that rolling back the chain restores the node state.
+
+The state of a node is the result of each RPC in STATE_RPCS, all sent in one
+JSON-RPC batch. Only a SHA256 digest of every result is compared, and results
+are diffed in full when their digests differ. Nodes are captured concurrently.
+
+These helpers are not part of DefiTestFramework. Tests import them where
+needed:
+
+    from test_framework.rollback import check_rollback
+
+    @check_rollback
+    def create_tokens(self):
+        ...
+"""
+
+import difflib
+import functools
+import hashlib
+import json
+import unittest
+
+from .authproxy import JSONRPCException
+from .util import call_all
+
+STATE_RPCS = [
+    "logaccountbalances",
+    "logstoredinterests",
+    "listvaults",
+    "listtokens",
+    "listgovs",
+    "listmasternodes",
+    "listaccounthistory",
+    "getburninfo",
+    "getloaninfo",
+    "listanchors",
+    "listgovproposals",
+    "listburnhistory",
+    "listcommunitybalances",
+]
+
+# Lines of diff shown per mismatching RPC
+MAX_DIFF_LINES = 40
+
+
+def _encode(result):
+    return json.dumps(result, sort_keys=True, indent=1, default=str)
+
+
+class NodeState:
+    """RPC results of one node at its current tip.
+
+    An RPC that fails, e.g. because it is not available before a fork
+    height, is recorded with its error."""
+
+    def __init__(self, node, rpcs=STATE_RPCS):
+        self.index = node.index
+        requests = [node.getbestblockhash.get_request()]
+        requests += [getattr(node, rpc).get_request() for rpc in rpcs]
+        responses = node.batch(requests)
+        self.tip = responses[0]["result"]
+        self.results = {}
+        self.digests = {}
+        for rpc, response in zip(rpcs, responses[1:]):
+            error = response.get("error")
+            if error is not None:
+                if isinstance(error, JSONRPCException):
+                    error = error.error
+                result = {"error": error}
+            else:
+                result = response["result"]
+            self.results[rpc] = result
+            self.digests[rpc] = hashlib.sha256(_encode(result).encode()).digest()
+
+    def diff(self, other):
+        """Return a description of the RPC results that differ from other."""
+        lines = []
+        if self.tip != other.tip:
+            lines.append("tip: {} != {}".format(self.tip, other.tip))
+        for rpc, digest in self.digests.items():
+            if other.digests.get(rpc) == digest:
+                continue
+            diff = difflib.unified_diff(
+                _encode(self.results[rpc]).splitlines(),
+                _encode(other.results.get(rpc)).splitlines(),
+                rpc + " before",
+                rpc + " after",
+                lineterm="",
+            )
+            lines += list(diff)[:MAX_DIFF_LINES]
+        return "\n".join(lines)
+
+
+def capture_state(nodes, rpcs=STATE_RPCS):
+    """Capture the NodeState of each node."""
+    return call_all(nodes, lambda node: NodeState(node, rpcs))
+
+
+def assert_state_equal(before, after):
+    for old, new in zip(before, after):
+        diff = old.diff(new)
+        if diff:
+            raise AssertionError(
+                "[node {}] State not restored:\n{}".format(old.index, diff)
+            )
+
+
+def check_rollback(func):
+    """Decorate a test method to check that it can be rolled back.
+
+    The state of all nodes is captured before func runs. The chain is then
+    rolled back to the height of node 0 before func, and the state must be
+    the same as before. Returns the result of func."""
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        height = self.nodes[0].getblockcount()
+        before = capture_state(self.nodes)
+        result = func(self, *args, **kwargs)
+        self.rollback_to(height)
+        assert_state_equal(before, capture_state(self.nodes))
+        return result
+
+    return wrapper
+
+
+class TestFrameworkRollback(unittest.TestCase):
+    class FakeNode:
+        index = 0
+
+        def __init__(self, results):
+            self.results = results
+
+        def __getattr__(self, rpc):
+            return type("Method", (), {"get_request": lambda _: rpc})()
+
+        def batch(self, requests):
+            return [
+                (
+                    {"error": {"code": -32600, "message": "unavailable"}}
+                    if self.results.get(rpc) is None
+                    else {"result": self.results[rpc]}
+                )
+                for rpc in requests
+            ]
+
+    def state(self, **results):
+        results.setdefault("getbestblockhash", "00")
+        return NodeState(self.FakeNode(results), ["listtokens", "listgovs"])
+
+    def test_equal(self):
+        a = self.state(listtokens={"0": {"symbol": "DFI"}})
+        b = self.state(listtokens={"0": {"symbol": "DFI"}})
+        self.assertEqual(a.diff(b), "")
+        assert_state_equal([a], [b])
+
+    def test_diff(self):
+        a = self.state(listtokens={"0": {"symbol": "DFI"}})
+        b = self.state(listtokens={"0": {"symbol": "DFI"}, "1": {"symbol": "BTC"}})
+        diff = a.diff(b)
+        self.assertIn("listtokens after", diff)
+        self.assertIn('"BTC"', diff)
+        self.assertNotIn("listgovs", diff)
+        self.assertRaises(AssertionError, assert_state_equal, [a], [b])
+
+    def test_tip(self):
+        a = self.state()
+        b = self.state(getbestblockhash="01")
+        self.assertIn("tip: 00 != 01", a.diff(b))
@@ -8,16 +8,21 @@ This file is modified from python-bitcoinlib.
 """
 
 from .messages import (
-    CTransaction,
     CTxOut,
     sha256,
     hash256,
     uint256_from_str,
+    ser_compact_size,
     ser_uint256,
     ser_string,
+    ser_vector,
 )
 
+import hashlib
+import os
 import struct
+import time
+import unittest
 
 from .bignum import bn2vch
 from .ripemd160 import ripemd160
@@ -27,8 +32,44 @@ MAX_SCRIPT_ELEMENT_SIZE = 520
 OPCODE_NAMES = {}
 
 
+def _openssl_ripemd160():
+    """Return an empty hashlib RIPEMD-160 object if OpenSSL provides a
+    correct implementation, otherwise None."""
+    try:
+        h = hashlib.new("ripemd160")
+    except ValueError:
+        return None
+    probe = h.copy()
+    probe.update(b"abc")
+    if probe.hexdigest() != "8eb208f7e05d987a9b044a8e98c6b087f15a0bfc":
+        return None
+    return h
+
+
+# Probed once at import. OpenSSL 3 only has RIPEMD-160 in its legacy provider.
+_RIPEMD160 = _openssl_ripemd160()
+
+
 def hash160(s):
-    return ripemd160(sha256(s))
+    if _RIPEMD160 is None:
+        return ripemd160(sha256(s))
+    h = _RIPEMD160.copy()
+    h.update(hashlib.sha256(s).digest())
+    return h.digest()
+
+
+def hash160_many(items):
+    """Return [hash160(s) for s in items]."""
+    if _RIPEMD160 is None:
+        return [ripemd160(sha256(s)) for s in items]
+    copy = _RIPEMD160.copy
+    sha = hashlib.sha256
+    result = []
+    for s in items:
+        h = copy()
+        h.update(sha(s).digest())
+        result.append(h.digest())
+    return result
 
 
 _opcode_instances = []
@@ -646,43 +687,41 @@ def SignatureHash(script, txTo, inIdx, hashtype):
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b""
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1F) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
 
-    elif (hashtype & 0x1F) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    # Serialize the modified copy of txTo directly instead of building it
+    base_type = hashtype & 0x1F
+    if base_type == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
+    script_code = ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+    keep_sequence = base_type not in (SIGHASH_NONE, SIGHASH_SINGLE)
 
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
-
-    hash = hash256(s)
+        vin = [inIdx]
+    else:
+        vin = range(len(txTo.vin))
+    r = [struct.pack("<i", txTo.nVersion), ser_compact_size(len(vin))]
+    for i in vin:
+        txin = txTo.vin[i]
+        r.append(txin.prevout.serialize())
+        if i == inIdx:
+            r.append(script_code)
+            r.append(struct.pack("<I", txin.nSequence))
+        else:
+            r.append(b"\x00")
+            r.append(struct.pack("<I", txin.nSequence if keep_sequence else 0))
+
+    if base_type == SIGHASH_NONE:
+        r.append(ser_vector([]))
+    elif base_type == SIGHASH_SINGLE:
+        r.append(ser_compact_size(inIdx + 1))
+        r.extend([CTxOut(-1).serialize()] * inIdx)
+        r.append(txTo.vout[inIdx].serialize())
+    else:
+        r.append(ser_vector(txTo.vout))
+    r.append(struct.pack("<I", txTo.nLockTime))
+    r.append(struct.pack(b"<I", hashtype))
+
+    hash = hash256(b"".join(r))
 
     return (hash, None)
 
@@ -697,9 +736,7 @@ def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
+        serialize_prevouts = b"".join(i.prevout.serialize() for i in txTo.vin)
         hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
 
     if (
@@ -707,15 +744,11 @@ def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
         and (hashtype & 0x1F) != SIGHASH_SINGLE
         and (hashtype & 0x1F) != SIGHASH_NONE
     ):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
+        serialize_sequence = b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin)
         hashSequence = uint256_from_str(hash256(serialize_sequence))
 
     if (hashtype & 0x1F) != SIGHASH_SINGLE and (hashtype & 0x1F) != SIGHASH_NONE:
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
+        serialize_outputs = b"".join(o.serialize() for o in txTo.vout)
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
     elif (hashtype & 0x1F) == SIGHASH_SINGLE and inIdx < len(txTo.vout):
         serialize_outputs = txTo.vout[inIdx].serialize()
@@ -734,3 +767,29 @@ def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
     ss += struct.pack("<I", hashtype)
 
     return hash256(ss)
+
+
+class TestFrameworkScript(unittest.TestCase):
+    def test_hash160(self):
+        """hash160 and hash160_many must match the pure Python RIPEMD-160."""
+        items = [bytes(range(n % 256)) * (n // 256 + 1) for n in range(0, 600, 7)]
+        expected = [ripemd160(sha256(s)) for s in items]
+        self.assertEqual([hash160(s) for s in items], expected)
+        self.assertEqual(hash160_many(items), expected)
+
+    @unittest.skipUnless(os.getenv("DEFI_BENCH"), "set DEFI_BENCH=1 to run")
+    def test_bench_hash160(self):
+        """Compare the speed of hash160 with the pure Python RIPEMD-160."""
+        items = [i.to_bytes(33, "big") for i in range(500)]
+        for name, fn in [
+            ("python", lambda items: [ripemd160(sha256(s)) for s in items]),
+            ("hash160_many", hash160_many),
+        ]:
+            start = time.perf_counter()
+            fn(items)
+            elapsed = time.perf_counter() - start
+            print(
+                "\n{}: {:.2f} us per hash160 (openssl: {})".format(
+                    name, elapsed * 1e6 / len(items), _RIPEMD160 is not None
+                )
+            )
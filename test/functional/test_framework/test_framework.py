@@ -5,7 +5,10 @@
 """Base class for RPC testing."""
 
 import configparser
+import contextlib
 from enum import Enum
+import hashlib
+import json
 import logging
 import argparse
 import os
@@ -26,7 +29,9 @@ from .util import (
     MAX_NODES,
     PortSeed,
     assert_equal,
+    call_all,
     check_json_precision,
+    clone_datadir,
     connect_nodes,
     connect_nodes_bi,
     disconnect_nodes,
@@ -49,6 +54,9 @@ TEST_EXIT_SKIPPED = 77
 
 TMPDIR_PREFIX = "defi_func_test_"
 
+# Seconds after which an unused chain fixture is removed from --fixturedir
+FIXTURE_MAX_AGE = 7 * 24 * 3600
+
 
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
@@ -120,6 +128,12 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
         self.supports_cli = False
         self.bind_to_localhost_only = True
+        self.chain_fixture = None
+        # Mocktime for the first start of nodes restored from a chain fixture
+        self._fixture_mocktime = None
+        # Nodes and seconds spent per lifecycle operation, see _node_lifecycle
+        self.lifecycle_times = {}
+        self._lifecycle_operation = None
         self.set_test_params()
 
         assert hasattr(
@@ -152,6 +166,11 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             ),
             help="Directory for caching pregenerated datadirs (default: %(default)s)",
         )
+        parser.add_argument(
+            "--fixturedir",
+            dest="fixturedir",
+            help="Directory for storing chain fixtures across test runs, not flushed by test_runner (default: fixtures next to the cache directory)",
+        )
         parser.add_argument(
             "--tmpdir", dest="tmpdir", help="Root directory for datadirs"
         )
@@ -169,6 +188,13 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             action="store_true",
             help="Print out all RPC calls as they are made",
         )
+        parser.add_argument(
+            "--tracerpcjsonl",
+            dest="trace_rpc_jsonl",
+            default=False,
+            action="store_true",
+            help="Write a JSON line per RPC call (method, sizes, latency) to rpc_trace.jsonl in each node's datadir",
+        )
         parser.add_argument(
             "--portseed",
             dest="port_seed",
@@ -228,6 +254,11 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         check_json_precision()
 
         self.options.cachedir = os.path.abspath(self.options.cachedir)
+        if self.options.fixturedir is None:
+            self.options.fixturedir = os.path.join(
+                os.path.dirname(self.options.cachedir), "fixtures"
+            )
+        self.options.fixturedir = os.path.abspath(self.options.fixturedir)
 
         config = configparser.ConfigParser()
         config.read_file(open(self.options.configfile))
@@ -321,6 +352,7 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
             for node in self.nodes:
                 node.cleanup_on_exit = False
             self.log.info("Note: defids were not stopped and may still be running")
+        self._log_lifecycle_times()
 
         should_clean_up = (
             not self.options.nocleanup
@@ -414,7 +446,9 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
     def setup_chain(self):
         """Override this method to customize blockchain setup"""
         self.log.info("Initializing test directory " + self.options.tmpdir)
-        if self.setup_clean_chain:
+        if self.setup_clean_chain and self.chain_fixture is not None:
+            self._initialize_chain_fixture()
+        elif self.setup_clean_chain:
             self._initialize_chain_clean()
         else:
             self._initialize_chain()
@@ -487,29 +521,32 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         node.clearmempool()
 
     # rollback to block
-    # nodes param is a list of node numbers to roll back ([0, 1, 2, 3...] (Default -> None -> node 0)
+    # nodes param is a list of nodes to roll back (Default -> None -> all nodes)
+    # Every step runs on all nodes concurrently.
     def rollback_to(self, block, nodes=None):
         nodes = nodes or self.nodes
-        connections = {}
-        for node in nodes:
-            nodes_connections = []
-            for x in node.getpeerinfo():
-                if not x["inbound"]:
-                    node_number = re.findall(r"\d+", x["subver"])[-1]
-                    nodes_connections.append(int(node_number))
-            connections[node] = nodes_connections
-
-        for node in nodes:
+
+        def outbound_peers(node):
+            return [
+                int(re.findall(r"\d+", x["subver"])[-1])
+                for x in node.getpeerinfo()
+                if not x["inbound"]
+            ]
+
+        connections = dict(zip(nodes, call_all(nodes, outbound_peers)))
+
+        def disconnect(node):
             for x in connections[node]:
                 disconnect_nodes(node, x)
 
-        for node in nodes:
-            self._rollback_to(block, node)
-
-        for node in nodes:
+        def reconnect(node):
             for x in connections[node]:
                 connect_nodes(node, x)
 
+        call_all(nodes, disconnect)
+        call_all(nodes, lambda node: self._rollback_to(block, node))
+        call_all(nodes, reconnect)
+
     def run_test(self):
         """Tests must override this method to define test logic"""
         raise NotImplementedError
@@ -552,6 +589,7 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
                     use_cli=self.options.usecli,
                     start_perf=self.options.perf,
                     use_valgrind=self.options.valgrind,
+                    trace_rpc=self.options.trace_rpc_jsonl,
                 )
             )
 
@@ -560,8 +598,9 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
 
         node = self.nodes[i]
 
-        node.start(*args, **kwargs)
-        node.wait_for_rpc_connection()
+        with self._node_lifecycle("start"):
+            node.start(*args, **kwargs)
+            node.wait_for_rpc_connection()
 
         if TestNode.Mocktime is not None:
             node.setmocktime(TestNode.Mocktime)
@@ -575,15 +614,25 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         if extra_args is None:
             extra_args = [None] * self.num_nodes
         assert_equal(len(extra_args), self.num_nodes)
+
+        def start_rpc(node):
+            node.wait_for_rpc_connection()
+            # The fixture's chain was built on its mocktime, so restored nodes
+            # need it before setup_network connects and syncs them
+            if self._fixture_mocktime is not None:
+                node.setmocktime(self._fixture_mocktime)
+
         try:
-            for i, node in enumerate(self.nodes):
-                node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            with self._node_lifecycle("start", len(self.nodes)):
+                for i, node in enumerate(self.nodes):
+                    node.start(extra_args[i], *args, **kwargs)
+                call_all(self.nodes, start_rpc)
         except Exception:
             # If one node failed to start, stop the others
             self.stop_nodes()
             raise
+        finally:
+            self._fixture_mocktime = None
 
         if self.options.coveragedir is not None:
             for node in self.nodes:
@@ -591,23 +640,26 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
 
     def stop_node(self, i, expected_stderr="", wait=0):
         """Stop a defid test node"""
-        self.nodes[i].stop_node(expected_stderr, wait=wait)
-        self.nodes[i].wait_until_stopped()
+        with self._node_lifecycle("stop"):
+            self.nodes[i].stop_node(expected_stderr, wait=wait)
+            self.nodes[i].wait_until_stopped()
 
     def stop_nodes(self, wait=0):
-        """Stop multiple defid test nodes"""
-        for node in self.nodes:
-            # Issue RPC to stop nodes
-            node.stop_node(wait=wait)
+        """Stop multiple defid test nodes concurrently"""
 
-        for node in self.nodes:
-            # Wait for nodes to stop
+        def stop(node):
+            # Issue RPC to stop node and wait for it to exit
+            node.stop_node(wait=wait)
             node.wait_until_stopped()
 
+        with self._node_lifecycle("stop", len(self.nodes)):
+            call_all(self.nodes, stop)
+
     def restart_node(self, i, extra_args=None):
         """Stop and start a test node"""
-        self.stop_node(i)
-        self.start_node(i, extra_args)
+        with self._node_lifecycle("restart"):
+            self.stop_node(i)
+            self.start_node(i, extra_args)
 
     def wait_for_node_exit(self, i, timeout):
         self.nodes[i].process.wait(timeout)
@@ -640,6 +692,38 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
 
     # Private helper methods. These should not be accessed by the subclass test scripts.
 
+    @contextlib.contextmanager
+    def _node_lifecycle(self, operation, num_nodes=1):
+        """Add the time spent in the block to lifecycle_times.
+
+        Operations inside another one, like the stop and start of a restart,
+        are only counted as part of the outer operation."""
+        if self._lifecycle_operation is not None:
+            yield
+            return
+        self._lifecycle_operation = operation
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._lifecycle_operation = None
+            count, total = self.lifecycle_times.get(operation, (0, 0.0))
+            self.lifecycle_times[operation] = (
+                count + num_nodes,
+                total + time.time() - start,
+            )
+
+    def _log_lifecycle_times(self):
+        if self.lifecycle_times:
+            self.log.info(
+                "Node lifecycle: {}".format(
+                    ", ".join(
+                        "{} {} node(s) in {:.2f}s".format(operation, count, total)
+                        for operation, (count, total) in self.lifecycle_times.items()
+                    )
+                )
+            )
+
     def _start_logging(self):
         # Add logger and logging handlers
         self.log = logging.getLogger("TestFramework")
@@ -763,11 +847,13 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
                     os.remove(cache_path(entry))
 
         for i in range(self.num_nodes):
+            to_dir = get_datadir_path(self.options.tmpdir, i)
+            stats = clone_datadir(cache_node_dir, to_dir)
             self.log.debug(
-                "Copy cache directory {} to node {}".format(cache_node_dir, i)
+                "Cloned cache directory {} to node {} ({})".format(
+                    cache_node_dir, i, stats
+                )
             )
-            to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
             initialize_datadir(
                 self.options.tmpdir, i, self.chain
             )  # Overwrite port/rpcport in defi.conf
@@ -780,6 +866,100 @@ class DefiTestFramework(metaclass=DefiTestMetaClass):
         for i in range(self.num_nodes):
             initialize_datadir(self.options.tmpdir, i, self.chain)
 
+    def _initialize_chain_fixture(self):
+        """Initialize the datadirs from the cached state of self.chain_fixture.
+
+        On a cache miss the fixture is built on a clean chain using the test's
+        own network setup, then the nodes are stopped and their datadirs are
+        stored in --fixturedir for later runs. Stored fixtures that have not
+        been used for FIXTURE_MAX_AGE seconds are removed then."""
+        fixture_dir = self._get_fixture_dir()
+        if os.path.isdir(fixture_dir):
+            self.log.info("Restoring chain fixture from {}".format(fixture_dir))
+            for i in range(self.num_nodes):
+                stats = clone_datadir(
+                    get_datadir_path(fixture_dir, i),
+                    get_datadir_path(self.options.tmpdir, i),
+                )
+                self.log.debug("Restored node {} ({})".format(i, stats))
+                initialize_datadir(
+                    self.options.tmpdir, i, self.chain
+                )  # Overwrite port/rpcport in defi.conf
+            with open(os.path.join(fixture_dir, "fixture.json"), encoding="utf8") as f:
+                TestNode.Mocktime = json.load(f)["mocktime"]
+            self._fixture_mocktime = TestNode.Mocktime
+            # Mark the fixture as used, see _prune_fixtures
+            os.utime(fixture_dir)
+            return
+
+        self.log.info("Building chain fixture {}".format(self.chain_fixture.name))
+        self._initialize_chain_clean()
+        self.setup_network()
+        self.chain_fixture.setup(self)
+        self.stop_nodes()
+        self.nodes = []
+        self._fixture_mocktime = TestNode.Mocktime
+
+        # Store into a private directory first and rename it into place, so
+        # concurrent test processes never see a partially written fixture.
+        os.makedirs(os.path.dirname(fixture_dir), exist_ok=True)
+        staging_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(fixture_dir) + ".",
+            dir=os.path.dirname(fixture_dir),
+        )
+        for i in range(self.num_nodes):
+            clone_datadir(
+                get_datadir_path(self.options.tmpdir, i),
+                get_datadir_path(staging_dir, i),
+                ignore=shutil.ignore_patterns(
+                    "stdout", "stderr", "debug.log", ".cookie", ".lock", "*.pid"
+                ),
+            )
+        with open(os.path.join(staging_dir, "fixture.json"), "w", encoding="utf8") as f:
+            json.dump(
+                {"name": self.chain_fixture.name, "mocktime": TestNode.Mocktime}, f
+            )
+        try:
+            os.rename(staging_dir, fixture_dir)
+        except OSError:
+            # Another test process stored the same fixture first
+            shutil.rmtree(staging_dir)
+        self._prune_fixtures()
+
+    def _prune_fixtures(self):
+        """Remove the stored fixtures that have not been used recently, e.g.
+        those of an older defid binary."""
+        fixtures_dir = self.options.fixturedir
+        cutoff = time.time() - FIXTURE_MAX_AGE
+        for name in os.listdir(fixtures_dir):
+            path = os.path.join(fixtures_dir, name)
+            try:
+                if os.path.isdir(path) and os.stat(path).st_mtime < cutoff:
+                    shutil.rmtree(path)
+            except OSError:
+                # Removed by another test process
+                pass
+
+    def _get_fixture_dir(self):
+        """Return the --fixturedir directory of self.chain_fixture.
+
+        The directory name contains a hash of the defid binary, the node
+        setup of this test and the source code of the fixture's setup."""
+        key = hashlib.sha256()
+        with open(self.options.defid, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                key.update(chunk)
+        key.update(
+            json.dumps(
+                [self.chain, self.num_nodes, getattr(self, "extra_args", None)]
+            ).encode("utf8")
+        )
+        key.update(self.chain_fixture.source().encode("utf8"))
+        return os.path.join(
+            self.options.fixturedir,
+            "{}_{}".format(self.chain_fixture.name, key.hexdigest()[:16]),
+        )
+
     def skip_if_no_py3_zmq(self):
         """Attempt to import the zmq package and skip the test if the import fails."""
         try:
@@ -4,18 +4,23 @@
 # file LICENSE or http://www.opensource.org/licenses/mit-license.php.
 """Class for defid node under test"""
 
+import codecs
 import contextlib
 import decimal
 import errno
+import functools
 from enum import Enum
 import http.client
 import json
 import logging
 import os
 import re
+import select
 import subprocess
 import tempfile
+import threading
 import time
+import unittest
 import urllib.parse
 import collections
 import shlex
@@ -24,18 +29,167 @@ import sys
 from test_framework.tokenamount import TokenAmount
 from web3 import Web3
 
-from .authproxy import JSONRPCException
+from .authproxy import JSONRPCException, RPCTrace
 from .util import (
     append_config,
     delete_cookie_file,
     get_rpc_proxy,
     rpc_url,
     get_conf_data,
-    wait_until,
     p2p_port,
 )
 
 DEFID_PROC_WAIT_TIMEOUT = 60
+# First and longest wait between attempts to connect to a starting node's RPC
+RPC_POLL_INTERVAL = 0.01
+RPC_POLL_INTERVAL_MAX = 0.25
+
+
+def wait_for_process_exit(process, timeout):
+    """Wait until process has exited. Returns False on timeout.
+
+    On Linux the wait blocks on a pidfd, other platforms use Popen.wait."""
+    if process.poll() is not None:
+        return True
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:  # Not supported by the kernel
+            pass
+        else:
+            try:
+                select.select([pidfd], [], [], timeout)
+            finally:
+                os.close(pidfd)
+            return process.poll() is not None
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        return False
+    return True
+
+
+class LogWatch:
+    """Messages that a waiter expects, or does not expect, in a log."""
+
+    def __init__(self, expected_msgs, unexpected_msgs, start):
+        # An empty message matches any log
+        self.pending = [msg for msg in expected_msgs if msg]
+        self.unexpected = list(unexpected_msgs)
+        self.unexpected_found = []
+        self.start = start
+        # The end of the text fed so far is searched again with the next
+        # text, so that messages split between two reads still match
+        self._keep = max(map(len, self.pending + self.unexpected), default=1) - 1
+        self._tail = ""
+
+    def feed(self, text):
+        text = self._tail + text
+        if self.pending:
+            self.pending = [msg for msg in self.pending if msg not in text]
+        for msg in self.unexpected:
+            if msg in text and msg not in self.unexpected_found:
+                self.unexpected_found.append(msg)
+        self._tail = text[-self._keep :] if self._keep else ""
+
+    def done(self):
+        return not self.pending or bool(self.unexpected_found)
+
+
+class DebugLogFollower:
+    """Follows a node's debug.log, reading every byte of it only once.
+
+    Waiters register a LogWatch and poll until it is done. Each poll reads
+    the text added to the log since the last poll, and every registered
+    watch searches it for the messages it still waits for. The log is read
+    from its start again when it is replaced or truncated. close() releases
+    the file, which is reopened at the same position by the next poll."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._inode = None
+        self._pos = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._watches = []
+        self._lock = threading.Lock()
+        # Only text logged from now on is followed
+        try:
+            st = os.stat(path)
+            self._inode, self._pos = st.st_ino, st.st_size
+        except FileNotFoundError:
+            pass
+
+    def _open(self):
+        """Open the log at the current position, or at its start if it was
+        replaced or truncated. Returns False if there is no log yet."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != self._inode or st.st_size < self._pos:
+            self._close()
+            self._inode, self._pos = st.st_ino, 0
+            self._decoder.reset()
+        if self._file is None:
+            self._file = open(self.path, "rb")
+            self._file.seek(self._pos)
+        return True
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def poll(self):
+        """Pass the text added to the log to the registered watches."""
+        with self._lock:
+            if not self._open():
+                return
+            data = self._file.read()
+            if not data:
+                return
+            self._pos += len(data)
+            text = self._decoder.decode(data)
+            if text and self._watches:
+                for watch in self._watches:
+                    watch.feed(text)
+
+    def watch(self, expected_msgs, unexpected_msgs=None):
+        """Register a LogWatch for the lines logged from now on."""
+        self.poll()
+        with self._lock:
+            watch = LogWatch(expected_msgs, unexpected_msgs or [], self._pos)
+            self._watches.append(watch)
+        return watch
+
+    def wait(self, watch, timeout):
+        """Poll until watch is done or timeout seconds have passed, then
+        unregister it."""
+        time_end = time.time() + timeout
+        try:
+            while True:
+                self.poll()
+                if watch.done() or time.time() >= time_end:
+                    return
+                time.sleep(0.05)
+        finally:
+            with self._lock:
+                self._watches.remove(watch)
+
+    def format_log(self, watch):
+        """Return the lines logged since watch was registered, for errors."""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(watch.start)
+                log = f.read().decode("utf-8", "replace")
+        except OSError:
+            log = ""
+        return " - " + "\n - ".join(log.splitlines())
 
 
 class FailedToStartError(Exception):
@@ -80,11 +234,14 @@ class TestNode:
         use_cli=False,
         start_perf=False,
         use_valgrind=False,
+        trace_rpc=False,
     ):
         """
         Kwargs:
             start_perf (bool): If True, begin profiling the node with `perf` as soon as
                 the node starts.
+            trace_rpc (bool): If True, record all RPC and EVM-RPC calls in
+                rpc_trace.jsonl in the datadir.
         """
 
         self.index = i
@@ -98,6 +255,11 @@ class TestNode:
         self.rpc_timeout = timewait
         self.binary = defid
         self.coverage_dir = coverage_dir
+        self.rpc_trace = (
+            RPCTrace(os.path.join(self.datadir, "rpc_trace.jsonl"))
+            if trace_rpc
+            else None
+        )
         self.cwd = cwd
         if extra_conf is not None:
             append_config(datadir, extra_conf)
@@ -149,6 +311,8 @@ class TestNode:
 
         self.running = False
         self.process = None
+        self.start_time = None
+        self._debug_log_follower = None
         self.rpc_connected = False
         self.rpc = None
         self.evm_rpc = None
@@ -222,6 +386,11 @@ class TestNode:
         ),
     ]
     Mocktime = None
+    # Maximum number of mining attempts sent in a single generate() batch
+    GENERATE_BATCH_SIZE = 100
+    # Size of the first generate() batch, doubled after every batch that
+    # followed the loop. Fewer blocks than this are mined one by one.
+    GENERATE_BATCH_MIN = 8
 
     EVM_CALLS = {
         # block
@@ -304,7 +473,15 @@ class TestNode:
     def reset_mocktime(self):
         TestNode.Mocktime = None
 
-    def generate(self, nblocks, maxtries=1000000, address=None):
+    def generate(self, nblocks, maxtries=1000000, address=None, batch=True):
+        """Mine nblocks to address, advancing mocktime by one second per block.
+
+        Once mocktime is known, blocks are mined in JSON-RPC batches (see
+        _generate_batch), starting with GENERATE_BATCH_MIN attempts and
+        doubling up to GENERATE_BATCH_SIZE. As soon as a PoS attempt in a
+        batch fails or mints a block at another time than its mocktime, the
+        rest is mined one block per round trip, as are fewer than
+        GENERATE_BATCH_MIN blocks."""
         if address is None:
             address = self.get_genesis_keys().ownerAuthAddress
 
@@ -312,7 +489,24 @@ class TestNode:
         minted = 0
         mintedHashes = []
         i = 0
+        batch_size = self.GENERATE_BATCH_MIN
         while minted < nblocks and i < maxtries:
+            if (
+                batch
+                and TestNode.Mocktime is not None
+                and nblocks - minted >= self.GENERATE_BATCH_MIN
+            ):
+                hashes, tries, followed = self._generate_batch(
+                    min(nblocks - minted, maxtries - i, batch_size), address
+                )
+                i += tries
+                minted += len(hashes)
+                mintedHashes += hashes
+                if not followed:
+                    # Finish with the one-by-one loop from the tip's time
+                    batch = False
+                batch_size = min(2 * batch_size, self.GENERATE_BATCH_SIZE)
+                continue
             if TestNode.Mocktime is not None:
                 self.setmocktime(TestNode.Mocktime + 1)
             res = self.generatetoaddress(nblocks=1, address=address, maxtries=1)
@@ -326,6 +520,67 @@ class TestNode:
                 )  # always "tip" due to chain switching (possibly wrong)
         return mintedHashes
 
+    def _generate_batch(self, tries, address):
+        """Make `tries` single-block mining attempts in one JSON-RPC batch.
+
+        Attempt k is a setmocktime(Mocktime + k)/generatetoaddress/
+        getbestblockhash triple. The loop in generate() makes the same
+        attempts as long as each one mints a block whose time is its
+        mocktime, which is checked afterwards. The staker may fail or pick
+        another block time, and then the rest of the batch no longer follows
+        the loop. Those attempts have already run, so the blocks they minted
+        are kept, but mocktime is taken from the tip and the caller finishes
+        with the loop. The first RPC error is raised like in the loop, after
+        taking mocktime from the tip as well.
+
+        Returns (minted block hashes, attempts made, whether all attempts
+        followed the loop)."""
+        mocktime = TestNode.Mocktime
+        requests = []
+        for k in range(1, tries + 1):
+            requests += [
+                self.setmocktime.get_request(mocktime + k),
+                self.generatetoaddress.get_request(
+                    nblocks=1, address=address, maxtries=1
+                ),
+                self.getbestblockhash.get_request(),
+            ]
+        try:
+            responses = self._batch_results(requests)
+        except JSONRPCException:
+            self.pullup_mocktime()
+            raise
+
+        minted = [k for k in range(tries) if responses[3 * k + 1] == 1]
+        hashes = [responses[3 * k + 2] for k in minted]
+        headers = self._batch_results(
+            [self.getblockheader.get_request(h) for h in hashes]
+        )
+        times = [header["time"] for header in headers]
+        followed = minted == list(range(tries)) and times == [
+            mocktime + k for k in range(1, tries + 1)
+        ]
+        if followed:
+            TestNode.Mocktime = times[-1]
+        else:
+            self.pullup_mocktime()
+        return hashes, tries, followed
+
+    def _batch_results(self, requests):
+        """Send requests in one batch and return their results, raising the
+        first error."""
+        results = []
+        for response in self.batch(requests):
+            error = response.get("error")
+            if error is not None:
+                raise (
+                    error
+                    if isinstance(error, JSONRPCException)
+                    else JSONRPCException(error)
+                )
+            results.append(response["result"])
+        return results
+
     def _node_msg(self, msg: str) -> str:
         """Return a modified msg that identifies this node by its index as a debugging aid."""
         return "[node %d] %s" % (self.index, msg)
@@ -393,6 +648,7 @@ class TestNode:
         )
 
         self.running = True
+        self.start_time = time.time()
         self.log.debug("defid started, waiting for RPC to come up")
 
         if self.start_perf:
@@ -400,9 +656,16 @@ class TestNode:
 
     def wait_for_rpc_connection(self):
         """Sets up an RPC connection to the defid process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
+        self.log.debug(self.index)
+        self.log.debug(self.args)
+        self.log.debug(get_conf_data(self.datadir))
+        # Poll at growing intervals, up to four times per second
+        poll_interval = RPC_POLL_INTERVAL
+        deadline = time.time() + self.rpc_timeout
+        # One proxy per endpoint is reused until the node is ready
+        rpc = None
+        evm_rpc = None
+        while time.time() < deadline:
             if self.process.poll() is not None:
                 raise FailedToStartError(
                     self._node_msg(
@@ -412,28 +675,37 @@ class TestNode:
                     )
                 )
             try:
-                self.log.debug(self.index)
-                self.log.debug(self.args)
-                self.log.debug(get_conf_data(self.datadir))
-                rpc = get_rpc_proxy(
-                    rpc_url(self.datadir, self.index, 1, self.chain, self.rpchost),
-                    self.index,
-                    timeout=self.rpc_timeout,
-                    coveragedir=self.coverage_dir,
-                )
+                if rpc is None:
+                    # Fails until the cookie file has been written
+                    rpc = get_rpc_proxy(
+                        rpc_url(self.datadir, self.index, 1, self.chain, self.rpchost),
+                        self.index,
+                        timeout=self.rpc_timeout,
+                        coveragedir=self.coverage_dir,
+                        trace=self.rpc_trace,
+                    )
                 rpc.getblockcount()
                 # If the call to getblockcount() succeeds then the RPC connection is up
                 self.log.debug("RPC successfully started")
 
-                evm_rpc = get_rpc_proxy(
-                    rpc_url(self.datadir, self.index, 3, self.chain, self.evm_rpchost),
-                    self.index,
-                    timeout=self.rpc_timeout,
-                    coveragedir=self.coverage_dir,
-                )
+                if evm_rpc is None:
+                    evm_rpc = get_rpc_proxy(
+                        rpc_url(
+                            self.datadir, self.index, 3, self.chain, self.evm_rpchost
+                        ),
+                        self.index,
+                        timeout=self.rpc_timeout,
+                        coveragedir=self.coverage_dir,
+                        trace=self.rpc_trace,
+                    )
                 evm_rpc.eth_blockNumber()
                 # If the call to eth_blockNumber() succeeds then the evm-RPC connection is up
                 self.log.debug("EVM-RPC successfully started")
+                self.log.debug(
+                    "RPC ready {:.3f}s after start".format(
+                        time.time() - self.start_time
+                    )
+                )
 
                 if self.use_cli:
                     return
@@ -461,7 +733,8 @@ class TestNode:
             ) as e:  # cookie file not found and no rpcuser or rpcassword. defid still starting
                 if "No RPC credentials" not in str(e):
                     raise
-            time.sleep(1.0 / poll_per_s)
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, RPC_POLL_INTERVAL_MAX)
         self._raise_assertion_error("Unable to connect to defid")
 
     def get_wallet_rpc(self, wallet_name):
@@ -495,6 +768,7 @@ class TestNode:
 
         self.stdout.close()
         self.stderr.close()
+        self.cli.close()
 
         del self.p2ps[:]
 
@@ -509,6 +783,12 @@ class TestNode:
         if return_code is None:
             return False
 
+        # The next debug.log assertion and the next traced call reopen the files
+        if self._debug_log_follower is not None:
+            self._debug_log_follower.close()
+        if self.rpc_trace is not None:
+            self.rpc_trace.close()
+
         # process has stopped. Assert that it didn't return an error code.
         assert return_code == 0, self._node_msg(
             "Node returned non-zero exit code (%d) when stopping" % return_code
@@ -522,38 +802,52 @@ class TestNode:
         return True
 
     def wait_until_stopped(self, timeout=DEFID_PROC_WAIT_TIMEOUT):
-        wait_until(self.is_node_stopped, timeout=timeout)
+        if self.running and not wait_for_process_exit(self.process, timeout):
+            self._raise_assertion_error(
+                "Node did not stop within {} seconds".format(timeout)
+            )
+        assert self.is_node_stopped()
+
+    def debug_log_follower(self):
+        """Return the DebugLogFollower of this node's debug.log."""
+        if self._debug_log_follower is None:
+            self._debug_log_follower = DebugLogFollower(
+                os.path.join(self.datadir, self.chain, "debug.log")
+            )
+        return self._debug_log_follower
 
     @contextlib.contextmanager
-    def assert_debug_log(self, expected_msgs, timeout=2):
-        time_end = time.time() + timeout
-        debug_log = os.path.join(self.datadir, self.chain, "debug.log")
-        with open(debug_log, encoding="utf-8") as dl:
-            dl.seek(0, 2)
-            prev_size = dl.tell()
+    def assert_debug_log(self, expected_msgs, unexpected_msgs=None, timeout=2):
+        """Assert that expected_msgs, and none of unexpected_msgs, are logged
+        while the context is active or within timeout seconds after it."""
+        follower = self.debug_log_follower()
+        watch = follower.watch(expected_msgs, unexpected_msgs)
         try:
             yield
         finally:
-            while True:
-                found = True
-                with open(debug_log, encoding="utf-8") as dl:
-                    dl.seek(prev_size)
-                    log = dl.read()
-                print_log = " - " + "\n - ".join(log.splitlines())
-                for expected_msg in expected_msgs:
-                    if (
-                        re.search(re.escape(expected_msg), log, flags=re.MULTILINE)
-                        is None
-                    ):
-                        found = False
-                if found:
-                    return
-                if time.time() >= time_end:
-                    break
-                time.sleep(0.05)
+            follower.wait(watch, timeout)
+            if watch.unexpected_found:
+                self._raise_assertion_error(
+                    'Unexpected messages "{}" partially match log:\n\n{}\n\n'.format(
+                        str(watch.unexpected_found), follower.format_log(watch)
+                    )
+                )
+            if watch.pending:
+                self._raise_assertion_error(
+                    'Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(
+                        str(expected_msgs), follower.format_log(watch)
+                    )
+                )
+
+    def wait_for_debug_log(self, expected_msgs, timeout=60):
+        """Wait until all of expected_msgs have been logged after this call."""
+        follower = self.debug_log_follower()
+        watch = follower.watch(expected_msgs)
+        follower.wait(watch, timeout)
+        if watch.pending:
             self._raise_assertion_error(
-                'Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(
-                    str(expected_msgs), print_log
+                'Expected messages "{}" not logged within {} seconds'.format(
+                    str(watch.pending), timeout
                 )
             )
 
@@ -760,7 +1054,7 @@ class TestNodeCLIAttr:
         return self.cli.send_cli(self.command, *args, **kwargs)
 
     def get_request(self, *args, **kwargs):
-        return lambda: self(*args, **kwargs)
+        return functools.partial(self.cli.send_cli, self.command, *args, **kwargs)
 
 
 def arg_to_cli(arg):
@@ -774,19 +1068,98 @@ def arg_to_cli(arg):
         return str(arg)
 
 
+class CLIWorkerPool:
+    """Warm defi-cli processes, each waiting for one command on stdin.
+
+    defi-cli started with -stdin and no command loads its configuration and
+    then blocks until the command and its arguments arrive on stdin, one per
+    line. Handing a command to such a process takes process startup off the
+    path of the call. A worker is replaced as soon as it is taken, and
+    workers started before defi.conf was last written are discarded."""
+
+    # Most idle workers kept for one set of defi-cli arguments
+    MAX_IDLE = 4
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _conf_mtime(self):
+        try:
+            return os.stat(self.conf).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _start(self, p_args):
+        return subprocess.Popen(
+            p_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+    def spawn(self, p_args):
+        """Start an idle worker for p_args, unless MAX_IDLE of them are
+        already waiting."""
+        with self._lock:
+            if len(self._idle[tuple(p_args)]) >= self.MAX_IDLE:
+                return
+        process = self._start(p_args)
+        with self._lock:
+            self._idle[tuple(p_args)].append((process, self._conf_mtime()))
+
+    def take(self, p_args):
+        """Return a warm worker for p_args, or a new process if none is
+        ready, and start a replacement."""
+        mtime = self._conf_mtime()
+        process = None
+        with self._lock:
+            idle = self._idle[tuple(p_args)]
+            while idle and process is None:
+                process, spawn_mtime = idle.pop(0)
+                if spawn_mtime != mtime or process.poll() is not None:
+                    self._kill(process)
+                    process = None
+            refill = not idle
+        if refill:
+            self.spawn(p_args)
+        return process or self._start(p_args)
+
+    @staticmethod
+    def _kill(process):
+        process.kill()
+        process.communicate()
+
+    def close(self):
+        """Stop all idle workers."""
+        with self._lock:
+            workers = [worker for idle in self._idle.values() for worker in idle]
+            self._idle.clear()
+        for process, _ in workers:
+            self._kill(process)
+
+
 class TestNodeCLI:
-    """Interface to defi-cli for an individual node"""
+    """Interface to defi-cli for an individual node
+
+    Commands are handed to warm defi-cli processes from a CLIWorkerPool
+    shared by all TestNodeCLI instances of the node. Calls with stdin input,
+    or with arguments that cannot be passed one per line, start a new
+    process."""
 
-    def __init__(self, binary, datadir):
+    def __init__(self, binary, datadir, pool=None):
         self.options = []
         self.binary = binary
         self.datadir = datadir
         self.input = None
+        self.pool = pool or CLIWorkerPool(os.path.join(datadir, "defi.conf"))
         self.log = logging.getLogger("TestFramework.deficli")
 
     def __call__(self, *options, input=None):
         # TestNodeCLI is callable with defi-cli command-line options
-        cli = TestNodeCLI(self.binary, self.datadir)
+        cli = TestNodeCLI(self.binary, self.datadir, self.pool)
         cli.options = [str(o) for o in options]
         cli.input = input
         return cli
@@ -794,7 +1167,22 @@ class TestNodeCLI:
     def __getattr__(self, command):
         return TestNodeCLIAttr(self, command)
 
+    def close(self):
+        self.pool.close()
+
     def batch(self, requests):
+        """Run requests one after another, in order.
+
+        defi-cli sends a single RPC per process, so the batch cannot be one
+        invocation. Instead, up to CLIWorkerPool.MAX_IDLE workers per set of
+        arguments are started up front and start up concurrently."""
+        for request in requests:
+            cli = getattr(getattr(request, "func", None), "__self__", None)
+            if isinstance(cli, TestNodeCLI) and request.args:
+                command, *args = request.args
+                worker = cli._worker_args(command, args, request.keywords)
+                if worker is not None:
+                    cli.pool.spawn(worker[0])
         results = []
         for request in requests:
             try:
@@ -803,8 +1191,7 @@ class TestNodeCLI:
                 results.append(dict(error=e))
         return results
 
-    def send_cli(self, command=None, *args, **kwargs):
-        """Run defi-cli command. Deserializes returned string as python object."""
+    def _cli_args(self, command, args, kwargs):
         pos_args = [arg_to_cli(arg) for arg in args]
         named_args = [
             str(key) + "=" + arg_to_cli(value) for (key, value) in kwargs.items()
@@ -815,18 +1202,42 @@ class TestNodeCLI:
         p_args = [self.binary, "-datadir=" + self.datadir] + self.options
         if named_args:
             p_args += ["-named"]
-        if command is not None:
-            p_args += [command]
-        p_args += pos_args + named_args
+        return p_args, pos_args + named_args
+
+    def _worker_args(self, command, args, kwargs):
+        p_args, cli_args = self._cli_args(command, args, kwargs)
+        lines = [command] + cli_args
+        if (
+            command is None
+            or self.input is not None
+            or any(o.startswith("-stdin") for o in self.options)
+            or any("\n" in line or "\r" in line for line in lines)
+        ):
+            return None
+        return p_args + ["-stdin"], lines
+
+    def send_cli(self, command=None, *args, **kwargs):
+        """Run defi-cli command. Deserializes returned string as python object."""
         self.log.debug("Running defi-cli command: %s" % command)
-        process = subprocess.Popen(
-            p_args,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        cli_stdout, cli_stderr = process.communicate(input=self.input)
+        worker = self._worker_args(command, args, kwargs)
+        if worker is not None:
+            p_args, lines = worker
+            process = self.pool.take(p_args)
+            cli_input = "\n".join(lines) + "\n"
+        else:
+            p_args, cli_args = self._cli_args(command, args, kwargs)
+            if command is not None:
+                p_args += [command]
+            p_args += cli_args
+            process = subprocess.Popen(
+                p_args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            cli_input = self.input
+        cli_stdout, cli_stderr = process.communicate(input=cli_input)
         returncode = process.poll()
         if returncode:
             match = re.match(r"error code: ([-0-9]+)\nerror message:\n(.*)", cli_stderr)
@@ -841,3 +1252,224 @@ class TestNodeCLI:
             return json.loads(cli_stdout, parse_float=decimal.Decimal)
         except json.JSONDecodeError:
             return cli_stdout.rstrip("\n")
+
+
+class TestFrameworkTestNode(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "debug.log")
+        self.write("old line\n")
+        self.follower = DebugLogFollower(self.path)
+
+    def tearDown(self):
+        self.follower.close()
+        self.dir.cleanup()
+
+    def write(self, text, mode="a"):
+        with open(self.path, mode, encoding="utf8") as f:
+            f.write(text)
+
+    def test_expected(self):
+        watch = self.follower.watch(["old", "new line", "split"])
+        self.write("new line\nspl")
+        self.follower.poll()
+        self.assertEqual(watch.pending, ["old", "split"])
+        self.write("it\n")
+        self.follower.wait(watch, 0)
+        self.assertEqual(watch.pending, ["old"])
+        self.assertEqual(self.follower.format_log(watch), " - new line\n - split")
+
+    def test_unexpected(self):
+        watch = self.follower.watch(["", "a"], ["b"])
+        self.write("b\n")
+        self.follower.wait(watch, 0)
+        self.assertTrue(watch.done())
+        self.assertEqual(watch.unexpected_found, ["b"])
+
+    def test_split(self):
+        watch = self.follower.watch(["split message"], ["bad line"])
+        for part in ["spl", "it mess", "age\nbad ", "li", "ne"]:
+            self.write(part)
+            self.follower.poll()
+        self.assertEqual(watch.pending, [])
+        self.assertEqual(watch.unexpected_found, ["bad line"])
+
+    def test_close(self):
+        watch = self.follower.watch(["after close"])
+        self.write("before\n")
+        self.follower.poll()
+        self.follower.close()
+        self.assertIsNone(self.follower._file)
+        self.write("after close\n")
+        self.follower.wait(watch, 0)
+        self.assertEqual(watch.pending, [])
+        self.assertEqual(self.follower.format_log(watch), " - before\n - after close")
+
+    def test_truncated(self):
+        watch = self.follower.watch(["restart"])
+        self.write("restart\n", mode="w")
+        self.follower.wait(watch, 0)
+        self.assertEqual(watch.pending, [])
+
+    class FakeStaker:
+        """RPC of a node whose staker mints a block at the mocktime, except for
+        the attempts in fail and one second later for the mocktimes in late."""
+
+        def __init__(self, fail=(), late=(), error=()):
+            self.blocks = [("%064x" % 0, 1000)]
+            self.mocktime = None
+            self.attempts = 0
+            self.fail = set(fail)
+            self.late = set(late)
+            self.error = set(error)
+            # Mining attempts per batch
+            self.batches = []
+
+        def setmocktime(self, mocktime):
+            self.mocktime = mocktime
+
+        def generatetoaddress(self, nblocks, address, maxtries):
+            self.attempts += 1
+            if self.attempts in self.error:
+                raise JSONRPCException({"code": -1, "message": "failed"})
+            if self.attempts in self.fail:
+                return 0
+            time = max(self.mocktime, self.blocks[-1][1] + 1)
+            time += self.mocktime in self.late
+            self.blocks.append(("%064x" % len(self.blocks), time))
+            return 1
+
+        def getbestblockhash(self):
+            return self.blocks[-1][0]
+
+        def getblockcount(self):
+            return len(self.blocks) - 1
+
+        def getblockhash(self, height):
+            return self.blocks[height][0]
+
+        def getblockheader(self, blockhash):
+            return {"time": dict(self.blocks)[blockhash]}
+
+        def batch(self, requests):
+            methods = [method for method, _, _ in requests]
+            if "generatetoaddress" in methods:
+                self.batches.append(methods.count("generatetoaddress"))
+            responses = []
+            for method, args, kwargs in requests:
+                try:
+                    result = getattr(self, method)(*args, **kwargs)
+                    responses.append({"result": result, "error": None})
+                except JSONRPCException as e:
+                    responses.append({"result": None, "error": e.error})
+            return responses
+
+    class FakeMethod:
+        def __init__(self, rpc, name):
+            self.rpc, self.name = rpc, name
+
+        def __call__(self, *args, **kwargs):
+            return getattr(self.rpc, self.name)(*args, **kwargs)
+
+        def get_request(self, *args, **kwargs):
+            return self.name, args, kwargs
+
+    def mine(self, nblocks, batch, **staker):
+        """Mine nblocks on a fake node, returning the block times and the
+        final mocktime."""
+        rpc = self.staker = self.FakeStaker(**staker)
+        node = TestNode.__new__(TestNode)
+        node.__dict__.update(use_cli=False, rpc_connected=True, process=None)
+        node.rpc = type(
+            "FakeRPC",
+            (),
+            {"__getattr__": lambda _, name: self.FakeMethod(rpc, name)},
+        )()
+        self.addCleanup(setattr, TestNode, "Mocktime", TestNode.Mocktime)
+        TestNode.Mocktime = 1000
+        hashes = node.generate(nblocks, address="addr", batch=batch)
+        self.assertEqual(hashes, [h for h, _ in rpc.blocks[1:]])
+        return [t for _, t in rpc.blocks], TestNode.Mocktime
+
+    def test_generate_batch(self):
+        """Batches mine the same blocks as the loop while the staker mints
+        every block at its mocktime."""
+        self.assertEqual(self.mine(250, batch=True), self.mine(250, batch=False))
+        self.assertEqual(self.staker.batches, [])
+        self.mine(250, batch=True)
+        self.assertEqual(self.staker.batches, [8, 16, 32, 64, 100, 30])
+        self.assertEqual(self.mine(7, batch=True), self.mine(7, batch=False))
+        self.assertEqual(self.staker.batches, [])
+
+    def test_generate_batch_error(self):
+        """An RPC error is raised after the batch it is in, with mocktime taken
+        from the tip."""
+        with self.assertRaises(JSONRPCException):
+            self.mine(250, batch=True, error=[20])
+        self.assertEqual(self.staker.batches, [8, 16])
+        self.assertEqual(len(self.staker.blocks), 24)
+        self.assertEqual(TestNode.Mocktime, self.staker.blocks[-1][1])
+
+    def test_generate_batch_diverged(self):
+        """After an attempt that does not follow the loop, mocktime is taken
+        from the tip and the loop finishes."""
+        for staker in [dict(fail=[30]), dict(late=[1020])]:
+            times, mocktime = self.mine(250, batch=True, **staker)
+            loop_times, _ = self.mine(250, batch=False, **staker)
+            self.assertEqual(len(times), 251)
+            self.assertEqual(mocktime, times[-1])
+            self.assertEqual(times[:30], loop_times[:30])
+
+    def fake_cli(self):
+        binary = os.path.join(self.dir.name, "defi-cli")
+        with open(binary, "w", encoding="utf8") as f:
+            f.write(
+                "#!{}\n".format(sys.executable)
+                + "import json, os, sys\n"
+                + "switches = [a for a in sys.argv[1:] if a.startswith('-')]\n"
+                + "args = [a for a in sys.argv[1:] if not a.startswith('-')]\n"
+                + "if '-stdin' in switches:\n"
+                + "    args += sys.stdin.read().splitlines()\n"
+                + "if args[0] == 'fail':\n"
+                + "    sys.exit('error code: -8\\nerror message:\\nbad')\n"
+                + "print(json.dumps(dict(args=args, stdin='-stdin' in switches,\n"
+                + "    named='-named' in switches, pid=os.getpid())))\n"
+            )
+        os.chmod(binary, 0o755)
+        cli = TestNodeCLI(binary, self.dir.name)
+        self.addCleanup(cli.close)
+        return cli
+
+    def test_cli(self):
+        cli = self.fake_cli()
+        result = cli.echo(1, "", {"a": [True]})
+        self.assertEqual(result["args"], ["echo", "1", "", '{"a": [true]}'])
+        self.assertTrue(result["stdin"])
+        self.assertTrue(cli.echo(a=True)["named"])
+        self.assertFalse(cli.echo("two\nlines")["stdin"])
+        self.assertFalse(cli(input="x").echo()["stdin"])
+        with self.assertRaises(JSONRPCException) as e:
+            cli.fail()
+        self.assertEqual(e.exception.error, dict(code=-8, message="bad"))
+
+    def test_cli_batch(self):
+        cli = self.fake_cli()
+        results = cli.batch([cli.echo.get_request(k) for k in range(3)])
+        self.assertEqual([r["result"]["args"][1] for r in results], ["0", "1", "2"])
+        self.assertEqual(len({r["result"]["pid"] for r in results}), 3)
+        results = cli.batch([cli.fail.get_request(), cli.echo.get_request()])
+        self.assertEqual(results[0]["error"].error["code"], -8)
+        self.assertEqual(results[1]["result"]["args"], ["echo"])
+        results = cli.batch([cli.echo.get_request(k) for k in range(10)])
+        self.assertEqual(len(results), 10)
+        idle = [len(workers) for workers in cli.pool._idle.values()]
+        self.assertLessEqual(max(idle), CLIWorkerPool.MAX_IDLE)
+
+    def test_cli_broken(self):
+        cli = self.fake_cli()
+        with open(cli.binary, "w", encoding="utf8") as f:
+            f.write("#!/bin/sh\necho broken >&2\nexit 1\n")
+        for _ in range(3):
+            with self.assertRaises(subprocess.CalledProcessError) as e:
+                cli.echo()
+            self.assertEqual(e.exception.output, "broken\n")
@@ -6,6 +6,7 @@
 
 from base64 import b64encode
 from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, ROUND_DOWN
 import inspect
 import json
@@ -13,10 +14,16 @@ import logging
 import os
 import random
 import re
+import shutil
 from subprocess import CalledProcessError
 import time
 import web3
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
 from . import coverage
 from .authproxy import AuthServiceProxy, JSONRPCException
 from io import BytesIO
@@ -368,7 +375,7 @@ class PortSeed:
     n = None
 
 
-def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
+def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None, trace=None):
     """
     Args:
         url (str): URL of the RPC server to call
@@ -376,6 +383,7 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
 
     Kwargs:
         timeout (int): HTTP timeout in seconds
+        trace (RPCTrace): record every call in this trace
 
     Returns:
         AuthServiceProxy. convenience object for making RPC calls.
@@ -384,6 +392,8 @@ def get_rpc_proxy(url, node_number, timeout=None, coveragedir=None):
     proxy_kwargs = {}
     if timeout is not None:
         proxy_kwargs["timeout"] = timeout
+    if trace is not None:
+        proxy_kwargs["trace"] = trace
 
     proxy = AuthServiceProxy(url, **proxy_kwargs)
     proxy.url = url  # store URL on proxy for info
@@ -452,6 +462,76 @@ def get_datadir_path(dirname, n):
     return os.path.join(dirname, "node" + str(n))
 
 
+# LevelDB/RocksDB table files are never modified once written, so they can be
+# shared between datadirs. Block and undo files are appended to by the node.
+IMMUTABLE_DATADIR_FILE_RE = re.compile(r".+\.(ldb|sst)$")
+# ioctl request number of FICLONE (share the extents of a file on Linux CoW
+# filesystems, e.g. btrfs and XFS)
+FICLONE = 0x40049409
+
+
+class DatadirCloneStats:
+    """Bytes shared or copied by clone_datadir()."""
+
+    def __init__(self):
+        self.hardlinked = 0
+        self.reflinked = 0
+        self.copied = 0
+
+    def __repr__(self):
+        return "{} bytes copied, {} reflinked, {} hardlinked".format(
+            self.copied, self.reflinked, self.hardlinked
+        )
+
+
+class _Reflink:
+    # Cleared after the first failed FICLONE, so that filesystems without
+    # support only pay for one failed ioctl per process.
+    supported = fcntl is not None and hasattr(fcntl, "ioctl")
+
+
+def _clone_file(src, dst, stats):
+    size = os.path.getsize(src)
+    if IMMUTABLE_DATADIR_FILE_RE.match(os.path.basename(src)):
+        try:
+            os.link(src, dst)
+            stats.hardlinked += size
+            return dst
+        except OSError:
+            pass
+    if _Reflink.supported:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            stats.reflinked += size
+            return dst
+        except OSError:
+            _Reflink.supported = False
+    shutil.copy2(src, dst)
+    stats.copied += size
+    return dst
+
+
+def clone_datadir(src, dst, ignore=None):
+    """Recursively clone the datadir src into the new directory dst.
+
+    Immutable database files are hardlinked, all other files are reflinked
+    where the filesystem supports it and copied otherwise.
+
+    Returns:
+        DatadirCloneStats. number of bytes per clone method.
+    """
+    stats = DatadirCloneStats()
+    shutil.copytree(
+        src,
+        dst,
+        ignore=ignore,
+        copy_function=lambda s, d: _clone_file(s, d, stats),
+    )
+    return stats
+
+
 def append_config(datadir, options):
     with open(os.path.join(datadir, "defi.conf"), "a", encoding="utf8") as f:
         for option in options:
@@ -547,6 +627,33 @@ def connect_nodes_bi(nodes, a, b):
     connect_nodes(nodes[b], a)
 
 
+# First poll interval of sync_blocks and sync_mempools. It doubles after every
+# poll, up to their wait argument.
+SYNC_POLL_INTERVAL = 0.01
+
+_sync_executor = None
+
+
+def call_all(rpc_connections, fn):
+    """Call fn on each node concurrently and return the results in order.
+
+    RPC proxies take a pooled connection per call, so the calls don't wait on
+    each other."""
+    global _sync_executor
+    if len(rpc_connections) < 2:
+        return [fn(r) for r in rpc_connections]
+    if _sync_executor is None:
+        _sync_executor = ThreadPoolExecutor(thread_name_prefix="RPCPool")
+    return list(_sync_executor.map(fn, rpc_connections))
+
+
+def _sync_poll_intervals(wait):
+    interval = SYNC_POLL_INTERVAL
+    while True:
+        yield min(interval, wait)
+        interval *= 2
+
+
 def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     """
     Wait until everybody has the same tip.
@@ -554,13 +661,17 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     sync_blocks needs to be called with an rpc_connections set that has least
     one node already synced to the latest, stable tip, otherwise there's a
     chance it might return before all nodes are stably synced.
+
+    Nodes are polled with an interval growing from SYNC_POLL_INTERVAL to
+    wait seconds.
     """
     stop_time = time.time() + timeout
+    intervals = _sync_poll_intervals(wait)
     while time.time() <= stop_time:
-        best_hash = [x.getbestblockhash() for x in rpc_connections]
+        best_hash = call_all(rpc_connections, lambda r: r.getbestblockhash())
         if best_hash.count(best_hash[0]) == len(rpc_connections):
             return
-        time.sleep(wait)
+        time.sleep(next(intervals))
     raise AssertionError(
         "Block sync timed out:{}".format(
             "".join("\n  {!r}".format(b) for b in best_hash)
@@ -568,20 +679,33 @@ def sync_blocks(rpc_connections, *, wait=1, timeout=60):
     )
 
 
+def _mempool_digest(node):
+    info = node.getmempoolinfo()
+    return info["size"], info["bytes"]
+
+
 def sync_mempools(rpc_connections, *, wait=1, timeout=60, flush_scheduler=True):
     """
     Wait until everybody has the same transactions in their memory
     pools
+
+    Mempools are first compared by transaction count and size, and the
+    txid lists are only fetched once those match on all nodes.
     """
     stop_time = time.time() + timeout
+    intervals = _sync_poll_intervals(wait)
     while time.time() <= stop_time:
-        pool = [set(r.getrawmempool()) for r in rpc_connections]
-        if pool.count(pool[0]) == len(rpc_connections):
-            if flush_scheduler:
-                for r in rpc_connections:
-                    r.syncwithvalidationinterfacequeue()
-            return
-        time.sleep(wait)
+        digest = call_all(rpc_connections, _mempool_digest)
+        if digest.count(digest[0]) == len(rpc_connections):
+            pool = call_all(rpc_connections, lambda r: set(r.getrawmempool()))
+            if pool.count(pool[0]) == len(rpc_connections):
+                if flush_scheduler:
+                    call_all(
+                        rpc_connections, lambda r: r.syncwithvalidationinterfacequeue()
+                    )
+                return
+        time.sleep(next(intervals))
+    pool = call_all(rpc_connections, lambda r: set(r.getrawmempool()))
     raise AssertionError(
         "Mempool sync timed out:{}".format("".join("\n  {!r}".format(m) for m in pool))
     )
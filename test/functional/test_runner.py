@@ -16,15 +16,20 @@ import argparse
 from collections import deque
 import configparser
 import datetime
+import heapq
+import json
 import os
+import queue
 import time
 import shutil
 import signal
 import sys
 import subprocess
 import tempfile
+import threading
 import re
 import logging
+import unittest
 from test_framework.test_framework import get_default_config_path
 
 # Formatting. Default colors to empty strings.
@@ -72,6 +77,21 @@ if os.name != "nt" or sys.getwindowsversion() >= (10, 0, 14393):
 TEST_EXIT_PASSED = 0
 TEST_EXIT_SKIPPED = 77
 
+# Number of RPC commands listed in the coverage report's timing table
+RPC_COVERAGE_TOP = 20
+
+# Test framework modules with unit tests, run before the functional tests
+TEST_FRAMEWORK_MODULES = [
+    "authproxy",
+    "key",
+    "messages",
+    "mininode",
+    "ripemd160",
+    "rollback",
+    "test_node",
+    "script",
+]
+
 EXTENDED_SCRIPTS = [
     # These tests are not run by default.
     # Longest test should go first, to favor running tests in parallel
@@ -372,7 +392,8 @@ EXPLICIT_IGNORES = [
     "example_rollback_check.py",
 ]
 
-# Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
+# Place EXTENDED_SCRIPTS first since it has the 3 longest running tests.
+# This order is kept for tests without a recorded runtime (see --timings).
 ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
 NON_SCRIPTS = [
@@ -462,6 +483,16 @@ def main():
         help="stop execution after the first test failure",
     )
     parser.add_argument("--filter", help="filter scripts to run by regular expression")
+    parser.add_argument(
+        "--shard",
+        metavar="i/n",
+        help="split the selected tests into n shards of about equal expected duration and only run shard i (1 <= i <= n). The timings file is not updated, so that all shards split the tests the same way",
+    )
+    parser.add_argument(
+        "--timings",
+        metavar="FILE",
+        help="file with per-test runtimes from previous runs, used to start the longest tests first and to balance --shard (default: test/timings.json in the build directory)",
+    )
 
     args, unknown_args = parser.parse_known_args()
     if not args.ansi:
@@ -556,6 +587,19 @@ def main():
     if args.filter:
         test_list = list(filter(re.compile(args.filter).search, test_list))
 
+    timings_file = args.timings or os.path.join(
+        config["environment"]["BUILDDIR"], "test", "timings.json"
+    )
+    timings = load_test_timings(timings_file)
+    test_list = sort_by_duration(test_list, timings)
+
+    if args.shard:
+        match = re.fullmatch(r"(\d+)/(\d+)", args.shard)
+        if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error("--shard must be of the form i/n with 1 <= i <= n")
+        shard, num_shards = int(match.group(1)), int(match.group(2))
+        test_list = shard_tests(test_list, timings, num_shards)[shard - 1]
+
     if not test_list:
         print(
             "No valid test scripts specified. Check that your test is in one "
@@ -600,6 +644,9 @@ def main():
         failfast=args.failfast,
         runs_ci=args.ci,
         use_term_control=args.ansi,
+        # Shards only read the timings, so that every shard computes the same
+        # split from the same file
+        timings_file=None if args.shard else timings_file,
     )
 
 
@@ -615,7 +662,8 @@ def run_tests(
     combined_logs_len=0,
     failfast=False,
     runs_ci,
-    use_term_control
+    use_term_control,
+    timings_file=None
 ):
     args = args or []
 
@@ -639,6 +687,20 @@ def run_tests(
 
     tests_dir = src_dir + "/test/functional/"
 
+    # Test Framework Tests
+    print("Running Unit Tests for Test Framework Modules")
+    test_framework_tests = unittest.TestSuite()
+    for module in TEST_FRAMEWORK_MODULES:
+        test_framework_tests.addTest(
+            unittest.TestLoader().loadTestsFromName("test_framework.{}".format(module))
+        )
+    result = unittest.TextTestRunner(verbosity=1, failfast=True).run(
+        test_framework_tests
+    )
+    if not result.wasSuccessful():
+        logging.debug("Early exiting after failure in TestFramework unit tests")
+        sys.exit(False)
+
     flags = ["--cachedir={}".format(cache_dir)] + args
 
     if enable_coverage:
@@ -717,6 +779,9 @@ def run_tests(
 
     print_results(test_results, max_len_name, (int(time.time() - start_time)))
 
+    if timings_file:
+        save_test_timings(timings_file, test_results)
+
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
 
@@ -774,11 +839,68 @@ def print_results(test_results, max_len_name, runtime):
     print(results)
 
 
+def load_test_timings(timings_file):
+    """Return the {test: seconds} runtimes recorded in timings_file."""
+    try:
+        with open(timings_file, encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_test_timings(timings_file, test_results):
+    """Merge the runtimes of passed tests into timings_file."""
+    timings = load_test_timings(timings_file)
+    for test_result in test_results:
+        if test_result.status == "Passed":
+            timings[test_result.name] = test_result.time
+    os.makedirs(os.path.dirname(os.path.abspath(timings_file)), exist_ok=True)
+    tmp_file = "{}.{}.tmp".format(timings_file, os.getpid())
+    with open(tmp_file, "w", encoding="utf8") as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, timings_file)
+
+
+def expected_duration(test, timings):
+    """Expected runtime of test. Tests without a recorded runtime are assumed
+    to be as slow as the slowest known test, so they are started early."""
+    return timings.get(test, max(timings.values(), default=0))
+
+
+def sort_by_duration(test_list, timings):
+    """Order tests longest first. Ties keep the order of test_list."""
+    return sorted(test_list, key=lambda test: -expected_duration(test, timings))
+
+
+def shard_tests(test_list, timings, num_shards):
+    """Split test_list into num_shards lists of about equal total duration.
+
+    Each test, longest first, goes to the shard with the least total
+    expected duration so far (the lowest index on ties), so every machine
+    computes the same split from the same timings."""
+    shards = [[] for _ in range(num_shards)]
+    totals = [0] * num_shards
+    for test in sort_by_duration(test_list, timings):
+        i = totals.index(min(totals))
+        shards[i].append(test)
+        # Count every test as at least one second to also spread out tests
+        # without recorded runtimes.
+        totals[i] += max(expected_duration(test, timings), 1)
+    return shards
+
+
 class TestHandler:
     """
     Trigger the test scripts passed in via the list.
+
+    Every running test has a thread blocked in Popen.wait() that reports
+    the test as finished, so a freed slot is refilled immediately. Test
+    timeouts are kept in a heap ordered by deadline.
     """
 
+    # Interval for progress dots and for re-sending SIGINT to timed out tests
+    TICK = 0.5
+
     def __init__(
         self,
         *,
@@ -800,6 +922,14 @@ class TestHandler:
         self.num_running = 0
         self.jobs = []
         self.use_term_control = use_term_control
+        # Jobs whose process has exited, in order of exit
+        self.finished = queue.Queue()
+        # (deadline, portseed, job) of running jobs
+        self.deadlines = []
+
+    def _wait_for_job(self, job):
+        job[2].wait()
+        self.finished.put(job)
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
@@ -815,25 +945,31 @@ class TestHandler:
                 self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed
             )
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
-            self.jobs.append(
-                (
-                    test,
-                    time.time(),
-                    subprocess.Popen(
-                        [sys.executable, self.tests_dir + test_argv[0]]
-                        + test_argv[1:]
-                        + self.flags
-                        + portseed_arg
-                        + tmpdir_arg,
-                        universal_newlines=True,
-                        stdout=log_stdout,
-                        stderr=log_stderr,
-                    ),
-                    testdir,
-                    log_stdout,
-                    log_stderr,
-                )
+            job = (
+                test,
+                time.time(),
+                subprocess.Popen(
+                    [sys.executable, self.tests_dir + test_argv[0]]
+                    + test_argv[1:]
+                    + self.flags
+                    + portseed_arg
+                    + tmpdir_arg,
+                    universal_newlines=True,
+                    stdout=log_stdout,
+                    stderr=log_stderr,
+                ),
+                testdir,
+                log_stdout,
+                log_stderr,
             )
+            self.jobs.append(job)
+            threading.Thread(
+                target=self._wait_for_job, args=(job,), daemon=True
+            ).start()
+            if self.timeout_duration != float("inf"):
+                heapq.heappush(
+                    self.deadlines, (job[1] + self.timeout_duration, portseed, job)
+                )
         if not self.jobs:
             raise IndexError("pop from empty list")
 
@@ -844,41 +980,53 @@ class TestHandler:
         dot_count = 0
         while True:
             # Return first proc that finishes
-            time.sleep(0.5)
-            for job in self.jobs:
-                (name, start_time, proc, testdir, log_out, log_err) = job
-                if int(time.time() - start_time) > self.timeout_duration:
-                    # Timeout individual tests if timeout is specified (to stop
-                    # tests hanging and not providing useful output).
-                    proc.send_signal(signal.SIGINT)
-                if proc.poll() is not None:
-                    log_out.seek(0), log_err.seek(0)
-                    [stdout, stderr] = [
-                        log_file.read().decode("utf-8")
-                        for log_file in (log_out, log_err)
-                    ]
-                    log_out.close(), log_err.close()
-                    if proc.returncode == TEST_EXIT_PASSED and stderr == "":
-                        status = "Passed"
-                    elif proc.returncode == TEST_EXIT_SKIPPED:
-                        status = "Skipped"
-                    else:
-                        status = "Failed"
-                    self.num_running -= 1
-                    self.jobs.remove(job)
-                    if self.use_term_control:
-                        clearline = "\r" + (" " * dot_count) + "\r"
-                        print(clearline, end="", flush=True)
-                    dot_count = 0
-                    return (
-                        TestResult(name, status, int(time.time() - start_time)),
-                        testdir,
-                        stdout,
-                        stderr,
-                    )
+            timeout = self.TICK
+            if self.deadlines:
+                timeout = min(timeout, max(0, self.deadlines[0][0] - time.time()))
+            try:
+                job = self.finished.get(timeout=timeout)
+            except queue.Empty:
+                self._signal_timed_out_jobs()
+                if self.use_term_control:
+                    print(".", end="", flush=True)
+                dot_count += 1
+                continue
+
+            (name, start_time, proc, testdir, log_out, log_err) = job
+            log_out.seek(0), log_err.seek(0)
+            [stdout, stderr] = [
+                log_file.read().decode("utf-8") for log_file in (log_out, log_err)
+            ]
+            log_out.close(), log_err.close()
+            if proc.returncode == TEST_EXIT_PASSED and stderr == "":
+                status = "Passed"
+            elif proc.returncode == TEST_EXIT_SKIPPED:
+                status = "Skipped"
+            else:
+                status = "Failed"
+            self.num_running -= 1
+            self.jobs.remove(job)
             if self.use_term_control:
-                print(".", end="", flush=True)
-            dot_count += 1
+                clearline = "\r" + (" " * dot_count) + "\r"
+                print(clearline, end="", flush=True)
+            return (
+                TestResult(name, status, int(time.time() - start_time)),
+                testdir,
+                stdout,
+                stderr,
+            )
+
+    def _signal_timed_out_jobs(self):
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, portseed, job = heapq.heappop(self.deadlines)
+            if job not in self.jobs:
+                # Already finished
+                continue
+            # Timeout individual tests if timeout is specified (to stop
+            # tests hanging and not providing useful output).
+            job[2].send_signal(signal.SIGINT)
+            heapq.heappush(self.deadlines, (now + self.TICK, portseed, job))
 
     def kill_and_join(self):
         """Send SIGKILL to all jobs and block until all have ended."""
@@ -992,10 +1140,23 @@ class RPCCoverage:
 
     def report_rpc_coverage(self):
         """
-        Print out RPC commands that were unexercised by tests.
+        Print out RPC commands that were unexercised by tests, and the RPC
+        commands that took the most time.
 
         """
         uncovered = self._get_uncovered_rpc_commands()
+        calls = self._get_rpc_calls()
+
+        if calls:
+            print("RPC commands by total time:")
+            print(
+                "".join(
+                    "  {:<40} {:>9} calls {:>10.2f}s\n".format(command, count, total)
+                    for command, (count, total) in sorted(
+                        calls.items(), key=lambda item: item[1][1], reverse=True
+                    )[:RPC_COVERAGE_TOP]
+                )
+            )
 
         if uncovered:
             print("Uncovered RPC commands:")
@@ -1008,6 +1169,32 @@ class RPCCoverage:
     def cleanup(self):
         return shutil.rmtree(self.dir)
 
+    def _get_rpc_calls(self):
+        """
+        Return the number of calls and total time in seconds of each RPC
+        command, summed over all tests.
+
+        """
+        # This is shared from `test/functional/test-framework/coverage.py`
+        coverage_file_prefix = "coverage."
+
+        calls = {}
+        for root, _, files in os.walk(self.dir):
+            for filename in files:
+                if not filename.startswith(coverage_file_prefix):
+                    continue
+                with open(
+                    os.path.join(root, filename), "r", encoding="utf8"
+                ) as coverage_file:
+                    for line in coverage_file:
+                        fields = line.split("\t")
+                        command = fields[0].strip()
+                        count = int(fields[1]) if len(fields) > 1 else 1
+                        total = float(fields[2]) if len(fields) > 2 else 0.0
+                        prev_count, prev_total = calls.get(command, (0, 0.0))
+                        calls[command] = (prev_count + count, prev_total + total)
+        return calls
+
     def _get_uncovered_rpc_commands(self):
         """
         Return a set of currently untested RPC commands.
@@ -1015,12 +1202,9 @@ class RPCCoverage:
         """
         # This is shared from `test/functional/test-framework/coverage.py`
         reference_filename = "rpc_interface.txt"
-        coverage_file_prefix = "coverage."
 
         coverage_ref_filename = os.path.join(self.dir, reference_filename)
-        coverage_filenames = set()
         all_cmds = set()
-        covered_cmds = set()
 
         if not os.path.isfile(coverage_ref_filename):
             raise RuntimeError("No coverage reference found")
@@ -1028,18 +1212,7 @@ class RPCCoverage:
         with open(coverage_ref_filename, "r", encoding="utf8") as coverage_ref_file:
             all_cmds.update([line.strip() for line in coverage_ref_file.readlines()])
 
-        for root, _, files in os.walk(self.dir):
-            for filename in files:
-                if filename.startswith(coverage_file_prefix):
-                    coverage_filenames.add(os.path.join(root, filename))
-
-        for filename in coverage_filenames:
-            with open(filename, "r", encoding="utf8") as coverage_file:
-                covered_cmds.update(
-                    [line.strip() for line in coverage_file.readlines()]
-                )
-
-        return all_cmds - covered_cmds
+        return all_cmds - set(self._get_rpc_calls())
 
 
 if __name__ == "__main__":